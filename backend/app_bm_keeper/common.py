@@ -5,13 +5,13 @@ from django.utils import timezone
 from rest_framework.response import Response
 
 from app_dataforge.models import StoreEntry
+from app_dataforge.fts import get_search_vector
 from app_bm_syncex.views import SOURCE
 
 def get_base_query(user_id, query_type='default'):
     """Enhanced base query builder supporting different query types"""
     base_conditions = {
         'user_id': user_id,
-        'block_id': 0,
         'is_deleted': 'f'
     }
     
@@ -70,6 +70,13 @@ def save_bookmark_changes(bookmark, changed_fields):
     if not changed_fields:
         return make_error_response(400, "No fields to update")
     changed_fields['updated_time'] = timezone.now()
+    if {'title', 'ctype', 'addr'} & set(changed_fields):
+        changed_fields['search_vector'] = get_search_vector(
+            changed_fields.get('title', bookmark.title),
+            bookmark.raw,
+            changed_fields.get('ctype', bookmark.ctype),
+            changed_fields.get('addr', bookmark.addr),
+        )
     rows_updated = StoreEntry.objects.filter(idx=bookmark.idx).update(**changed_fields)
     bookmark.refresh_from_db()
     
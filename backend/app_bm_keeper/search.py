@@ -1,10 +1,17 @@
 from django.db.models import Q
+from app_dataforge.fts import get_search_query
 from .common import save_bookmark_changes
 
 def search_bookmarks(query, keyword):
-    """Search bookmarks by keyword"""
+    """Search bookmarks by keyword in title, tags or URL (full-text index),
+    fall back to substring match as before (served by the trigram indexes)"""
+    search_query = get_search_query(keyword)
+    if search_query is not None:
+        results = query.filter(search_vector=search_query).order_by('-created_time')
+        if results.exists():
+            return results
     return query.filter(
-        Q(title__icontains=keyword) | 
+        Q(title__icontains=keyword) |
         Q(addr__icontains=keyword) |
         Q(ctype__icontains=keyword)
     ).order_by('-created_time')
@@ -0,0 +1,266 @@
+"""
+Background embedding backfill
+
+When the embedding model changes, the chunks of a user are embedded again by
+'manage.py embedding_backfill' instead of a client looping over regerate_embedding.
+A BackfillJob walks the entries of the user in idx order (store_entry_user_idx index),
+re-embeds their stale chunks (store_block_entry_ordinal index) in batches and writes them
+with bulk_update. The last idx done is saved as cursor, so a stopped job continues where
+it was, and EMBEDDING_BACKFILL_RATE limits how fast the embedding service is called.
+A pass with failed chunks is run again after BACKFILL_RETRY_DELAY, doubled every attempt.
+"""
+
+import os
+import time
+import socket
+import datetime
+import traceback
+from loguru import logger
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Q, Exists, OuterRef
+from django.utils import timezone
+
+from backend.common.llm.llm_hub import EmbeddingTools
+
+from .models import StoreEntry, StoreBlock, BackfillJob
+from . import emb_cache, vector_index, lease
+
+BACKFILL_ENTRY_BATCH = 100  # entries per query
+BACKFILL_BATCH_SIZE = 64  # chunks embedded and written at a time, env EMBEDDING_BACKFILL_BATCH
+BACKFILL_RATE = 0  # chunks per second, 0: no limit, env EMBEDDING_BACKFILL_RATE
+BACKFILL_MAX_ATTEMPTS = 3
+BACKFILL_RETRY_DELAY = 60  # seconds before the first retry
+BACKFILL_JOB_TIMEOUT = 600  # seconds without progress before a running job is claimed again
+BACKFILL_HEARTBEAT_INTERVAL = 60  # seconds between lease renewals of a running job
+BACKFILL_POLL_INTERVAL = 5  # seconds
+
+
+def get_batch_size():
+    return max(1, int(os.getenv("EMBEDDING_BACKFILL_BATCH", BACKFILL_BATCH_SIZE)))
+
+
+def get_rate():
+    return float(os.getenv("EMBEDDING_BACKFILL_RATE", BACKFILL_RATE))
+
+
+def get_stale_blocks(emb_model, user_id=None, entry_ids=None):
+    """
+    Chunks with text but without a vector of emb_model
+    """
+    queryset = (
+        StoreBlock.objects.filter(raw__isnull=False)
+        .exclude(raw="")
+        .filter(Q(emb_model__isnull=True) | ~Q(emb_model=emb_model) | Q(embeddings__isnull=True))
+    )
+    if user_id is not None:
+        queryset = queryset.filter(entry__user_id=user_id, entry__is_deleted=False)
+    if entry_ids is not None:
+        queryset = queryset.filter(entry_id__in=entry_ids)
+    return queryset
+
+
+def get_stale_addrs(user_id, emb_model):
+    stale = get_stale_blocks(emb_model).filter(entry=OuterRef("pk"))
+    return list(
+        StoreEntry.objects.filter(user_id=user_id, is_deleted=False)
+        .filter(Exists(stale))
+        .order_by()
+        .values_list("addr", flat=True)
+    )
+
+
+def throttle(count, elapsed, rate):
+    if rate > 0:
+        wait = count / rate - elapsed
+        if wait > 0:
+            time.sleep(wait)
+
+
+def embed_blocks(blocks, emb_model, on_batch=None):
+    """
+    Embed blocks batch by batch, write each batch with one bulk_update
+    Chunks of failed batches are left as they were, return (done, failed)
+    """
+    batch_size = get_batch_size()
+    rate = get_rate()
+    done = 0
+    failed = 0
+    for start in range(0, len(blocks), batch_size):
+        start_time = time.time()
+        batch = blocks[start : start + batch_size]
+        texts = [block.raw for block in batch]
+        hashes = [block.md5 or emb_cache.get_text_hash(block.raw) for block in batch]
+        ret, embeddings = emb_cache.embed_texts(texts, True, emb_model, hashes=hashes)
+        updated = []
+        for block, embedding in zip(batch, embeddings):
+            if embedding is None:
+                continue
+            block.embeddings = embedding
+            block.emb_model = emb_model
+            updated.append(block)
+        StoreBlock.objects.bulk_update(updated, ["embeddings", "emb_model"])
+        done += len(updated)
+        failed += len(batch) - len(updated)
+        if on_batch is not None:
+            on_batch(len(updated), len(batch) - len(updated))
+        throttle(len(batch), time.time() - start_time, rate)
+    return done, failed
+
+
+def mark_entries(entry_ids, emb_model):
+    """
+    Entries whose chunks all have a vector of emb_model take its name
+    """
+    stale = get_stale_blocks(emb_model).filter(entry=OuterRef("pk"))
+    StoreEntry.objects.filter(idx__in=entry_ids).exclude(Exists(stale)).update(emb_model=emb_model)
+
+
+def get_job_info(job):
+    return {
+        "job": str(job.idx),
+        "status": job.status,
+        "emb_model": job.emb_model,
+        "total": job.total,
+        "finished": job.finished,
+        "failed": job.failed,
+        "progress": round(job.finished / job.total, 3) if job.total > 0 else 1,
+        "error": job.error,
+    }
+
+
+def get_active_job(user_id, emb_model):
+    return BackfillJob.objects.filter(
+        user_id=user_id,
+        emb_model=emb_model,
+        status__in=[BackfillJob.Status.PENDING, BackfillJob.Status.RUNNING],
+    ).first()
+
+
+def create_job(user_id, emb_model):
+    """
+    Queue a backfill of the user, the queued or running job is returned if there is one
+    """
+    job = get_active_job(user_id, emb_model)
+    if job is not None:
+        return job
+    try:
+        with transaction.atomic():
+            job = BackfillJob.objects.create(
+                user_id=user_id,
+                emb_model=emb_model,
+                total=get_stale_blocks(emb_model, user_id=user_id).count(),
+            )
+    except IntegrityError:  # backfill_job_active, queued by a concurrent request
+        return get_active_job(user_id, emb_model)
+    logger.info(f"backfill job {job.idx} queued, {job.total} blocks of {user_id}")
+    return job
+
+
+def get_last_job(user_id):
+    return BackfillJob.objects.filter(user_id=user_id).order_by("-created_time").first()
+
+
+def claim_job(worker):
+    """
+    Take the oldest pending job, or a running one whose worker stopped reporting progress
+    """
+    now = timezone.now()
+    stale_time = now - datetime.timedelta(seconds=BACKFILL_JOB_TIMEOUT)
+    with transaction.atomic():
+        job = (
+            BackfillJob.objects.select_for_update(skip_locked=True)
+            .filter(
+                Q(status=BackfillJob.Status.PENDING)
+                & (Q(next_run_time__isnull=True) | Q(next_run_time__lte=now))
+                | Q(status=BackfillJob.Status.RUNNING, updated_time__lt=stale_time)
+            )
+            .order_by("created_time")
+            .first()
+        )
+        if job is None:
+            return None
+        job.status = BackfillJob.Status.RUNNING
+        job.worker = worker
+        job.attempts += 1
+        job.save(update_fields=["status", "worker", "attempts", "updated_time"])
+    return job
+
+
+def run_job(job):
+    """
+    Re-embed the stale chunks after job.cursor, progress is saved after every batch
+    """
+    emb_model = EmbeddingTools.get_model_name(EmbeddingTools.use_embedding())
+    if emb_model != job.emb_model:
+        job.status = BackfillJob.Status.FAILED
+        job.error = f"embedding model is {emb_model} now"
+        job.save(update_fields=["status", "error", "updated_time"])
+        return job
+
+    def on_batch(done, failed):
+        job.finished += done
+        job.failed += failed
+        job.save(update_fields=["finished", "failed", "updated_time"])
+
+    try:
+        # an embedding batch may be slow or throttled past BACKFILL_JOB_TIMEOUT
+        with lease.keep_lease(job, BACKFILL_HEARTBEAT_INTERVAL):
+            while True:
+                entries = StoreEntry.objects.filter(user_id=job.user_id, is_deleted=False)
+                if job.cursor is not None:
+                    entries = entries.filter(idx__gt=job.cursor)
+                entry_ids = list(
+                    entries.order_by("idx").values_list("idx", flat=True)[:BACKFILL_ENTRY_BATCH]
+                )
+                if len(entry_ids) == 0:
+                    break
+                blocks = list(
+                    get_stale_blocks(job.emb_model, entry_ids=entry_ids)
+                    .only("pk", "raw", "md5")
+                    .order_by("entry_id", "ordinal")
+                )
+                embed_blocks(blocks, job.emb_model, on_batch=on_batch)
+                mark_entries(entry_ids, job.emb_model)
+                job.cursor = entry_ids[-1]
+                job.save(update_fields=["cursor", "updated_time"])
+    except Exception as e:
+        traceback.print_exc()
+        job.error = str(e)
+        job.failed += 1
+
+    if job.failed == 0:
+        job.status = BackfillJob.Status.DONE
+        job.error = None
+    elif job.attempts < BACKFILL_MAX_ATTEMPTS:
+        # the next pass only finds the chunks that are still stale
+        job.status = BackfillJob.Status.PENDING
+        job.cursor = None
+        job.failed = 0
+        delay = BACKFILL_RETRY_DELAY * 2 ** (job.attempts - 1)
+        job.next_run_time = timezone.now() + datetime.timedelta(seconds=delay)
+    else:
+        job.status = BackfillJob.Status.FAILED
+    job.save(
+        update_fields=["status", "cursor", "failed", "error", "next_run_time", "updated_time"]
+    )
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    if job.status == BackfillJob.Status.DONE and not connection.in_atomic_block:
+        try:
+            vector_index.sync_indexes()
+        except Exception as e:
+            logger.warning(f"rebuild vector index failed {e}")
+    logger.info(f"backfill job {job.idx} {job.status}, {job.finished}/{job.total}")
+    return job
+
+
+def run_worker(once=False, interval=BACKFILL_POLL_INTERVAL):
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    logger.info(f"backfill worker {worker} started")
+    while True:
+        job = claim_job(worker)
+        if job is not None:
+            run_job(job)
+        elif once:
+            break
+        else:
+            time.sleep(interval)
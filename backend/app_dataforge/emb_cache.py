@@ -0,0 +1,165 @@
+"""
+Persistent embedding cache
+
+Vectors are stored per (emb_model, md5 of the text), so embedding a text again, for any
+user, by regerate_embedding or by saving a chat session once more, costs one indexed
+lookup instead of a call to the embedding service. The hash is the one of StoreBlock.md5,
+callers that have the chunk md5 pass it and the text is not hashed twice.
+Hits are counted in memory and written every HITS_FLUSH_INTERVAL seconds, not on every read.
+"""
+
+import os
+import time
+import datetime
+import threading
+from loguru import logger
+from django.db.models import F, Sum, Count
+from django.utils import timezone
+
+from backend.common.llm.llm_hub import EmbeddingTools
+from backend.common.parser import utils_md
+
+from .models import EmbeddingCache
+
+CACHE_BATCH_SIZE = 500
+HITS_FLUSH_INTERVAL = 60  # seconds
+
+_pending_hits = {}  # pk: hits not written yet
+_hits_lock = threading.Lock()
+_last_flush = time.time()
+
+
+def use_cache():
+    val = os.getenv("EMBEDDING_CACHE", "True")
+    return val.lower() == "true"
+
+
+def get_text_hash(text):
+    # md5 of the text as sent to the model, not normalised, it is StoreBlock.md5 of the chunk
+    return utils_md.get_text_md5(text)
+
+
+def add_hits(pks):
+    with _hits_lock:
+        for pk in pks:
+            _pending_hits[pk] = _pending_hits.get(pk, 0) + 1
+        if time.time() - _last_flush < HITS_FLUSH_INTERVAL:
+            return
+    flush_hits()
+
+
+def flush_hits():
+    """
+    Write the counted hits, one UPDATE per distinct count, and touch last_used for prune
+    """
+    global _pending_hits, _last_flush
+    with _hits_lock:
+        pending = _pending_hits
+        _pending_hits = {}
+        _last_flush = time.time()
+    groups = {}
+    for pk, hits in pending.items():
+        groups.setdefault(hits, []).append(pk)
+    now = timezone.now()
+    for hits, pks in groups.items():
+        for start in range(0, len(pks), CACHE_BATCH_SIZE):
+            EmbeddingCache.objects.filter(pk__in=pks[start : start + CACHE_BATCH_SIZE]).update(
+                hits=F("hits") + hits, last_used=now
+            )
+
+
+def get_cached(emb_model, hashes):
+    """
+    Cached vectors of the hashes, {text_hash: embeddings}, and count the hits
+    """
+    hashes = list(set(hashes))
+    cached = {}
+    for start in range(0, len(hashes), CACHE_BATCH_SIZE):
+        rows = EmbeddingCache.objects.filter(
+            emb_model=emb_model, text_hash__in=hashes[start : start + CACHE_BATCH_SIZE]
+        ).values_list("pk", "text_hash", "embeddings")
+        pks = []
+        for pk, text_hash, embeddings in rows:
+            pks.append(pk)
+            cached[text_hash] = embeddings
+        if len(pks) > 0:
+            add_hits(pks)
+    return cached
+
+
+def put_cached(emb_model, hashes, embeddings):
+    rows = {}
+    for text_hash, emb in zip(hashes, embeddings):
+        if emb is not None:
+            rows[text_hash] = EmbeddingCache(emb_model=emb_model, text_hash=text_hash, embeddings=emb)
+    EmbeddingCache.objects.bulk_create(
+        list(rows.values()), batch_size=CACHE_BATCH_SIZE, ignore_conflicts=True
+    )
+
+
+def embed_texts(all_splits, use_embedding, emb_model=None, hashes=None):
+    """
+    do_embedding through the cache, only texts without a cached vector are sent to the model
+    hashes: md5 of the texts if the caller has them
+    """
+    if not use_embedding or not use_cache():
+        return EmbeddingTools.do_embedding(all_splits, use_embedding)
+    if emb_model is None:
+        emb_model = EmbeddingTools.get_model_name(use_embedding)
+    if emb_model is None:
+        return EmbeddingTools.do_embedding(all_splits, use_embedding)
+
+    if hashes is None:
+        hashes = [get_text_hash(text) for text in all_splits]
+    cached = get_cached(emb_model, hashes)
+    todo = [idx for idx, text_hash in enumerate(hashes) if text_hash not in cached]
+    ret = True
+    embeddings = [cached.get(text_hash) for text_hash in hashes]
+    if len(todo) > 0:
+        ret, new_embeddings = EmbeddingTools.do_embedding(
+            [all_splits[idx] for idx in todo], use_embedding
+        )
+        # failed batches come back as None and are not cached
+        put_cached(emb_model, [hashes[idx] for idx in todo], new_embeddings)
+        for idx, emb in zip(todo, new_embeddings):
+            embeddings[idx] = emb
+    logger.debug(f"embedding cache {emb_model}, hit {len(hashes) - len(todo)}, miss {len(todo)}")
+    return ret, embeddings
+
+
+def get_stats():
+    """
+    Rows, hits and hit rate per model, every row was a miss once
+    Hits counted by other processes are there after their next flush
+    """
+    flush_hits()
+    stats = []
+    rows = (
+        EmbeddingCache.objects.values("emb_model")
+        .annotate(total_hits=Sum("hits"), rows=Count("pk"))
+        .order_by("emb_model")
+    )
+    for row in rows:
+        total = row["total_hits"] + row["rows"]
+        stats.append(
+            {
+                "emb_model": row["emb_model"],
+                "rows": row["rows"],
+                "hits": row["total_hits"],
+                "hit_rate": round(row["total_hits"] / total, 3) if total > 0 else 0,
+            }
+        )
+    return stats
+
+
+def prune(days, emb_model=None):
+    """
+    Remove vectors not used for days, or all vectors of emb_model when days is None
+    """
+    queryset = EmbeddingCache.objects.all()
+    if emb_model is not None:
+        queryset = queryset.filter(emb_model=emb_model)
+    if days is not None:
+        queryset = queryset.filter(last_used__lt=timezone.now() - datetime.timedelta(days=days))
+    count, _ = queryset.delete()
+    return count
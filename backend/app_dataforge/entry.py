@@ -8,8 +8,11 @@ import pytz
 import traceback
 from loguru import logger
 from django.utils import timezone
-from django.db.models import Q
-from django.contrib.postgres.search import TrigramSimilarity
+from django.db import connection, transaction
+from django.db.models import F, Func, Case, When, Value, IntegerField, FloatField
+from django.db.models.functions import Cast
+from django.contrib.postgres.search import TrigramSimilarity, SearchRank
+from pgvector.django import CosineDistance, VectorField
 from django.http import HttpResponse
 from django.utils.translation import gettext as _
 
@@ -23,17 +26,28 @@ from backend.common.parser.md_parser import MarkdownParser
 from backend.common.llm.llm_hub import EmbeddingTools
 from backend.common.user.user import UserManager
 
-from .models import StoreEntry
+from .models import StoreEntry, StoreBlock
+from .fts import get_search_query, get_search_vector
 from .feature import EntryFeatureTool, DEFAULT_CATEGORY
+from . import emb_cache, backfill, vector_index
 
 DESC_LENGTH = 50
 REL_DIR_FILES = "files"
 REL_DIR_NOTES = "notes"
+SEARCH_MODE_KEYWORD = "keyword"
+SEARCH_MODE_VECTOR = "vector"
+SEARCH_MODE_HYBRID = "hybrid"
+HYBRID_SEARCH_DEPTH = 50  # candidates per list, env HYBRID_SEARCH_DEPTH
+RRF_K = 60
+BLOCK_BATCH_SIZE = 200  # rows per INSERT when saving chunks
+TRIGRAM_SIMILARITY_THRESHOLD = 0.05  # same recall as the former similarity() > 0.05 filter
+VECTOR_SEARCH_CANDIDATE_FACTOR = 5  # blocks fetched per returned entry, before collapsing by addr
+VECTOR_RESCORE_FACTOR = 4  # compact index candidates per block, reranked with the full vectors, env VECTOR_RESCORE_FACTOR
 # get PARSE_CONTENT from backend env settings
 
-def add_data(dic, path=None, use_llm=True):
+def add_data(dic, path=None, use_llm=True, resume=False):
     """
-    path is the temporary file path to be uploaded
+    path is the temporary file path to be uploaded, resume: retry of a failed upload
     For the uploaded file, addr is the relative path for storage, under xxx/files/
     For ob notes, addr is the relative path for storage, under xxx/note/
     For web pages, addr is the URL
@@ -44,7 +58,7 @@ def add_data(dic, path=None, use_llm=True):
         use_llm = False
 
     if dic["etype"] == "file" or dic["etype"] == "note":
-        return add_file(dic, path, use_llm=use_llm)
+        return add_file(dic, path, use_llm=use_llm, resume=resume)
     elif dic["etype"] == "record":
         return add_record(dic, use_llm=use_llm)
     elif dic["etype"] == "chat":
@@ -81,27 +95,56 @@ def get_file_content_by_path(path, user):
         content = open(path, "r").read()
     return meta_data, content
 
-def add_file(dic, path, use_llm=True):
-    mtime_datetime = timezone.now().astimezone(pytz.UTC)
-    # logger.debug(f'save to serv {path}, {mtime_datetime}')
+def is_content_unchanged(dic):
+    """
+    The same content was already saved for this addr (and path) and embedded by the current model
+    """
+    if dic.get("md5") is None or dic.get("addr") is None:
+        return False
+    queryset = StoreEntry.objects.filter(
+        user_id=dic["user_id"],
+        addr=dic["addr"],
+        md5=dic["md5"],
+        emb_model=EmbeddingTools.get_model_name(EmbeddingTools.use_embedding()),
+        is_deleted=False,
+    )
+    if dic.get("path") is not None:
+        queryset = queryset.filter(path=dic["path"])
+    return queryset.exists()
 
-    user = UserManager.get_instance().get_user(dic["user_id"])
-    filename = os.path.basename(dic["addr"])
-    ret, dic = EntryFeatureTool.get_instance().parse(dic, filename, use_llm=use_llm)
 
-    if dic["etype"] == "note":
-        dic["path"] = os.path.join(REL_DIR_NOTES, dic["addr"])
-    if dic["etype"] == "file":
-        dic["path"] = os.path.join(REL_DIR_FILES, dic["addr"])
-    ret = utils_filemanager.get_file_manager().save_file(
-        dic["user_id"], dic["path"], path
+def update_entry_fields(dic):
+    """
+    Write the fields given in dic (status, title, ctype...) to the entry of dic["addr"],
+    its content, chunks and vectors are kept
+    """
+    entry = (
+        StoreEntry.objects.filter(user_id=dic["user_id"], addr=dic["addr"], is_deleted=False)
+        .only("idx", "title", "raw", "ctype", "addr")
+        .first()
     )
-    if not ret:
-        return False, False, _("save_file_failed_excl_")
+    if entry is None:
+        return False
+    fields = {
+        k: v
+        for k, v in filter_model_fields(dic).items()
+        if v is not None and k not in ["idx", "raw", "created_time"]
+    }
+    fields["updated_time"] = timezone.now().astimezone(pytz.UTC)  # update() skips auto_now
+    # update() skips StoreEntry.save too, search_vector is set here
+    fields["search_vector"] = get_search_vector(
+        fields.get("title", entry.title), entry.raw, fields.get("ctype", entry.ctype), entry.addr
+    )
+    return StoreEntry.objects.filter(idx=entry.idx).update(**fields) > 0
 
-    if "md5" not in dic or dic["md5"] is None:
-        dic["md5"] = utils_md.get_file_md5(path)
-    dic["created_time"] = mtime_datetime
+
+def parse_file(dic, path, use_llm=True):
+    """
+    Get the features, meta, content and abstract of an uploaded file
+    """
+    user = UserManager.get_instance().get_user(dic["user_id"])
+    filename = os.path.basename(dic["addr"])
+    ret, dic = EntryFeatureTool.get_instance().parse(dic, filename, use_llm=use_llm)
 
     if (dic['etype'] == 'note' and user.get("note_save_content")) or (dic['etype'] == 'file' and user.get("file_save_content")):
         meta_data, content = get_file_content_by_path(path, user)
@@ -119,64 +162,227 @@ def add_file(dic, path, use_llm=True):
         ret, detail = get_file_abstract(path, dic["user_id"])
         if ret:
             abstract = detail
+    return dic, abstract, content
+
+
+def add_file(dic, path, use_llm=True, resume=False):
+    mtime_datetime = timezone.now().astimezone(pytz.UTC)
+    # logger.debug(f'save to serv {path}, {mtime_datetime}')
+
+    if "md5" not in dic or dic["md5"] is None:
+        dic["md5"] = utils_md.get_file_md5(path)
+    if dic["etype"] == "note":
+        dic["path"] = os.path.join(REL_DIR_NOTES, dic["addr"])
+    if dic["etype"] == "file":
+        dic["path"] = os.path.join(REL_DIR_FILES, dic["addr"])
+    if is_content_unchanged(dic):
+        # the stored file and its chunks are the same, only parse/upload/embedding are skipped
+        logger.info(f"skip unchanged content {dic['addr']}")
+        update_entry_fields(dic)
+        return True, True, _("no_update_needed")
+    # upload in the background while the file is parsed, wait before the entry is saved
+    upload = utils_filemanager.get_file_manager().save_file_async(
+        dic["user_id"], dic["path"], path, md5=dic["md5"], resume=resume
+    )
 
+    try:
+        dic, abstract, content = parse_file(dic, path, use_llm=use_llm)
+    except Exception:
+        upload.exception()  # the caller removes path when we return, let the upload finish
+        raise
+    dic["created_time"] = mtime_datetime
+
+    if not upload.result():
+        return False, False, _("save_file_failed_excl_")
     return save_entry(dic, abstract, content)
 
 
-def filter_model_fields(data):
-    model_fields = {}
-    for f in StoreEntry._meta.get_fields():
-        max_length = getattr(f, 'max_length', None)
-        model_fields[f.name] = max_length
+def get_field_lengths(model):
+    return {f.name: getattr(f, "max_length", None) for f in model._meta.concrete_fields}
+
 
+ENTRY_FIELD_LENGTHS = get_field_lengths(StoreEntry)
+
+
+def filter_model_fields(data, field_lengths=ENTRY_FIELD_LENGTHS):
     filtered_data = {}
     for k, v in data.items():
-        if k in model_fields:
-            if isinstance(v, str) and model_fields[k] is not None:
-                if len(v) > model_fields[k]:
-                    logger.warning(f"Field '{k}' value too long ({len(v)}), truncating to {model_fields[k]} chars")
-                    v = v[:model_fields[k]]
+        if k in field_lengths:
+            if isinstance(v, str) and field_lengths[k] is not None:
+                if len(v) > field_lengths[k]:
+                    logger.warning(f"Field '{k}' value too long ({len(v)}), truncating to {field_lengths[k]} chars")
+                    v = v[:field_lengths[k]]
             filtered_data[k] = v         
     return filtered_data
 
 
+def get_reused_embeddings(user_id, hashes, emb_model):
+    """
+    Vectors of identical chunks already stored for the user, {md5: embeddings}
+    """
+    if len(hashes) == 0 or emb_model is None:
+        return {}
+    rows = (
+        StoreBlock.objects.filter(
+            entry__user_id=user_id,
+            md5__in=set(hashes),
+            emb_model=emb_model,
+            embeddings__isnull=False,
+        )
+        .order_by()
+        .values_list("md5", "embeddings")
+    )
+    return {md5: emb for md5, emb in rows}
+
+
+def get_block_embeddings(user_id, all_splits, hashes, use_embedding, emb_model):
+    """
+    Embed only the chunks whose md5 has no stored vector
+    """
+    if use_embedding == False:
+        return True, [None for split in all_splits]
+    reused = get_reused_embeddings(user_id, hashes, emb_model)
+    todo = [idx for idx, md5 in enumerate(hashes) if md5 not in reused]
+    ret_emb = True
+    new_embeddings = []
+    if len(todo) > 0:
+        ret_emb, new_embeddings = emb_cache.embed_texts(
+            [all_splits[idx] for idx in todo],
+            use_embedding,
+            emb_model,
+            hashes=[hashes[idx] for idx in todo],
+        )
+    embeddings = [reused.get(md5) for md5 in hashes]
+    for idx, emb in zip(todo, new_embeddings):
+        embeddings[idx] = emb
+    logger.debug(f"embedding blocks {len(todo)}, reused {len(hashes) - len(todo)}")
+    return ret_emb, embeddings
+
+
+def get_kept_blocks(entry, emb_model):
+    """
+    Chunks of the current entry that are still valid for emb_model, {md5: [(pk, ordinal), ...]}
+    """
+    kept = {}
+    if entry is None:
+        return kept
+    queryset = StoreBlock.objects.filter(entry=entry, emb_model=emb_model)
+    if emb_model is not None:
+        queryset = queryset.filter(embeddings__isnull=False)
+    for pk, ordinal, md5 in queryset.values_list("pk", "ordinal", "md5"):
+        kept.setdefault(md5, []).append((pk, ordinal))
+    return kept
+
+
+def match_blocks(hashes, kept):
+    """
+    Pair new chunks with unchanged stored ones by md5
+    Return {index of new chunk: (pk, old ordinal)} and the indexes left to insert
+    """
+    matched = {}
+    added = []
+    for idx, md5 in enumerate(hashes):
+        if len(kept.get(md5, [])) > 0:
+            matched[idx] = kept[md5].pop(0)
+        else:
+            added.append(idx)
+    return matched, added
+
+
+def save_blocks(entry, all_splits, hashes, embeddings, emb_model, matched, added):
+    """
+    Keep matched chunks (renumbered if they moved), delete the stale ones and insert
+    the added ones, BLOCK_BATCH_SIZE rows per statement
+    bulk_create skips StoreBlock.save(), so search_vector is set here
+    """
+    StoreBlock.objects.filter(entry=entry).exclude(
+        pk__in=[pk for pk, ordinal in matched.values()]
+    ).delete()
+    moved = [
+        StoreBlock(pk=pk, ordinal=idx + 1)
+        for idx, (pk, ordinal) in matched.items()
+        if ordinal != idx + 1
+    ]
+    if len(moved) > 0:
+        # (entry, ordinal) is checked row by row, park the moved rows on free ordinals first
+        StoreBlock.objects.filter(pk__in=[block.pk for block in moved]).update(
+            ordinal=-F("ordinal")
+        )
+        StoreBlock.objects.bulk_update(moved, ["ordinal"], batch_size=BLOCK_BATCH_SIZE)
+    blocks = [
+        StoreBlock(
+            entry=entry,
+            ordinal=idx + 1,
+            raw=all_splits[idx],
+            md5=hashes[idx],
+            embeddings=emb,
+            emb_model=emb_model if emb is not None else None,
+            search_vector=get_search_vector(None, all_splits[idx]),
+        )
+        for idx, emb in zip(added, embeddings)
+    ]
+    StoreBlock.objects.bulk_create(blocks, batch_size=BLOCK_BATCH_SIZE)
+    return len(blocks)
+
+
 def save_entry(dic, abstract, content, debug=False):
+    """
+    Save the entry of dic["addr"], replacing the current one
+    Unchanged chunks of the current entry keep their rows and vectors, only the
+    changed ones are embedded and written
+    """
     use_embedding = EmbeddingTools.use_embedding()
+    emb_model = EmbeddingTools.get_model_name(use_embedding)
     ret_emb = True
     try:
-        if "addr" in dic and dic["addr"] is not None:
-            StoreEntry.objects.filter(user_id=dic["user_id"], addr=dic["addr"]).delete()
-        dic["block_id"] = 0
-        dic["emb_model"] = EmbeddingTools.get_model_name(use_embedding)
         dic["raw"] = abstract
         if "created_time" not in dic:
             dic["created_time"] = timezone.now().astimezone(pytz.UTC)
         filtered_dic = filter_model_fields(dic)
-        StoreEntry.objects.create(**filtered_dic)
+        current = None
+        if "addr" in dic and dic["addr"] is not None:
+            current = (
+                StoreEntry.objects.filter(user_id=dic["user_id"], addr=dic["addr"])
+                .order_by("-updated_time")
+                .first()
+            )
+        all_splits = []
+        hashes = []
         if content:
             all_splits = EmbeddingTools.split(content)
             if len(all_splits) == 0:
                 all_splits = [content]
-            if use_embedding == False:
-                embeddings = [None for split in all_splits]
+            hashes = [utils_md.get_text_md5(text) for text in all_splits]
+        matched, added = match_blocks(hashes, get_kept_blocks(current, emb_model))
+        ret_emb, embeddings = get_block_embeddings(
+            dic["user_id"],
+            [all_splits[idx] for idx in added],
+            [hashes[idx] for idx in added],
+            use_embedding,
+            emb_model,
+        )
+        # the entry takes the model name only when all its chunks have a vector,
+        # so is_content_unchanged doesn't skip an entry whose embedding failed
+        embedded = ret_emb and all(emb is not None for emb in embeddings)
+        filtered_dic["emb_model"] = emb_model if embedded else None
+        if debug:
+            logger.debug(
+                f"save to serv, split blocks {len(all_splits)}, kept {len(matched)}, emb {ret_emb}"
+            )
+        with transaction.atomic():
+            if current is None:
+                entry = StoreEntry.objects.create(**filtered_dic)
             else:
-                ret_emb, embeddings = EmbeddingTools.do_embedding(
-                    all_splits, use_embedding
-                )
-            if debug:
-                logger.debug(
-                    f"save to serv, split blocks {len(all_splits)}, emb {ret_emb}"
-                )
-            for idx, (text, emb) in enumerate(zip(all_splits, embeddings)):
-                dic["block_id"] = idx + 1
-                dic["raw"] = text
-                if emb is not None:
-                    dic["embeddings"] = emb
-                elif "embeddings" in dic:
-                    dic.pop("embeddings")
-                filtered_dic = filter_model_fields(dic)
-                StoreEntry.objects.create(**filtered_dic)
-            logger.info(f'save blocks {idx}')
+                StoreEntry.objects.filter(user_id=dic["user_id"], addr=dic["addr"]).exclude(
+                    idx=current.idx
+                ).delete()
+                # a fresh row on the old idx, so fields missing in dic get their defaults
+                entry = StoreEntry(**filtered_dic)
+                entry.idx = current.idx
+                entry.save(force_update=True)
+            count = save_blocks(entry, all_splits, hashes, embeddings, emb_model, matched, added)
+        if count > 0:
+            logger.info(f'save blocks {count}, kept {len(matched)}')
         return True, ret_emb, _("add_success")
     except Exception as e:
         traceback.print_exc()
@@ -255,29 +461,27 @@ def delete_entry(uid, filelist):
         entrys = StoreEntry.objects.filter(user_id=uid, addr=addr)
         logger.warning(f"real delete {uid} addr {addr}, {entrys.count()}")
         for entry in entrys:
-            if entry.block_id == 0:
-                if entry.path is not None:
-                    utils_filemanager.get_file_manager().delete_file(uid, entry.path)
-                    logger.info(f"real delete server file {entry.path}")
-                entry.is_deleted = True
-                entry.updated_time = timezone.now().astimezone(pytz.UTC)
-                entry.save()
-            else:
-                entry.delete()
+            if entry.path is not None:
+                utils_filemanager.get_file_manager().delete_file(uid, entry.path)
+                logger.info(f"real delete server file {entry.path}")
+            entry.is_deleted = True
+            entry.updated_time = timezone.now().astimezone(pytz.UTC)
+            entry.save()
+            StoreBlock.objects.filter(entry=entry).delete()
 
 
 def regerate_embedding(uid, addr, emb_model):
     use_embedding = EmbeddingTools.use_embedding()
-    entrys = StoreEntry.objects.filter(user_id=uid, addr=addr)
-    if len(entrys) == 0 or not use_embedding:
+    blocks = list(
+        StoreBlock.objects.filter(entry__user_id=uid, entry__addr=addr, raw__isnull=False)
+        .exclude(raw="")
+        .only("pk", "raw", "md5", "entry_id")
+    )
+    if len(blocks) == 0 or not use_embedding:
         return False
-    all_splits = [entry.raw for entry in entrys]
-    ret_emb, embeddings = EmbeddingTools.do_embedding(all_splits, True)
-    if ret_emb:
-        for entry, embedding in zip(entrys, embeddings):
-            entry.embeddings = embedding
-            entry.emb_model = emb_model
-            entry.save()
+    # chunks embedded before a batch failed are kept, the rest is done on the next run
+    backfill.embed_blocks(blocks, emb_model)
+    backfill.mark_entries(set([block.entry_id for block in blocks]), emb_model)
     return True
 
 
@@ -305,53 +509,313 @@ def get_entry(idx):
         return None
 
 
-def get_entry_list(keywords, query_args, max_count, fields = None):
-    query_args["block_id"] = 0
+DEFAULT_LIST_FIELDS = [
+    "idx",
+    "block_id",
+    "raw",
+    "title",
+    "etype",
+    "atype",
+    "ctype",
+    "status",
+    "addr",
+    "path",
+    "created_time",
+    "updated_time",
+]
+
+
+def set_trigram_threshold(threshold, name="similarity_threshold"):
+    """
+    Threshold of the pg_trgm % (similarity_threshold) or <% (word_similarity_threshold) operator,
+    the operators can use the gin_trgm_ops indexes while similarity() > x can not
+    The setting lasts until the end of the transaction, call it inside transaction.atomic()
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT set_config(%s, %s, true)", [f"pg_trgm.{name}", str(threshold)]
+        )
+
+
+def get_trigram_matches(queryset, threshold, name="similarity_threshold"):
+    """
+    Primary keys of queryset, filtered by a pg_trgm operator, under threshold
+    The query runs in the transaction of the setting, other requests on the
+    connection keep the default threshold
+    """
+    with transaction.atomic():
+        set_trigram_threshold(threshold, name)
+        return list(queryset.values_list("pk", flat=True))
+
+
+def get_query_embedding(keywords):
+    """
+    Return (emb_model, embedding) of the search keywords, (None, None) if embedding is not available
+    """
+    use_embedding = EmbeddingTools.use_embedding()
+    emb_model = EmbeddingTools.get_model_name(use_embedding)
+    if emb_model is None:
+        return None, None
+    ret, embedding = EmbeddingTools.do_query_embedding(keywords, use_embedding)
+    if not ret:
+        return None, None
+    return emb_model, embedding
+
+
+def get_block_args(query_args):
+    """
+    Entry filters applied to StoreBlock through the entry relation
+    """
+    return {f"entry__{key}": value for key, value in query_args.items()}
+
+
+def get_vector_blocks(query_args, emb_model, embedding, candidates=None):
+    """
+    Blocks of the user ordered by cosine distance to embedding, annotated with the entry addr
+    With a compact index (halfvec/fewer dimensions) the index finds candidates * VECTOR_RESCORE_FACTOR
+    nearest blocks, which are reranked by the distance of the full vectors
+    Run it after vector_index.set_search_params(get_vector_scan_size(...)) in the same transaction
+    """
+    dim = len(embedding)
+    # same cast and predicates as the partial indexes in vector_index.py
+    queryset = StoreBlock.objects.annotate(
+        dims=Func(F("embeddings"), function="vector_dims", output_field=IntegerField())
+    ).filter(emb_model=emb_model, dims=dim, **get_block_args(query_args))
+    if candidates is not None and vector_index.is_compact(dim):
+        nearest = (
+            queryset.annotate(
+                compact_distance=CosineDistance(
+                    vector_index.get_index_expression(dim), vector_index.get_query_vector(embedding)
+                )
+            )
+            .order_by("compact_distance")
+            .values("pk")[: candidates * get_rescore_factor()]
+        )
+        queryset = StoreBlock.objects.filter(pk__in=nearest)
+    return queryset.annotate(
+        addr=F("entry__addr"),
+        distance=CosineDistance(Cast("embeddings", VectorField(dimensions=dim)), embedding),
+    ).order_by("distance")
+
+
+def get_rescore_factor():
+    return max(1, int(os.getenv("VECTOR_RESCORE_FACTOR", VECTOR_RESCORE_FACTOR)))
+
+
+def get_vector_scan_size(dim, candidates):
+    """
+    Rows the index scan of get_vector_blocks(..., candidates) has to return, see set_search_params
+    """
+    if vector_index.is_compact(dim):
+        return candidates * get_rescore_factor()
+    return candidates
+
+
+def get_entries_by_addrs(addrs, scores, query_args, max_count, fields):
+    """
+    Parent rows of addrs, keep the order of addrs and attach the score of each hit
+    """
+    if len(addrs) == 0:
+        return StoreEntry.objects.none().values(*fields)
+    ordering = Case(
+        *[When(addr=addr, then=pos) for pos, addr in enumerate(addrs)],
+        output_field=IntegerField(),
+    )
+    score = Case(
+        *[When(addr=addr, then=Value(value)) for addr, value in zip(addrs, scores)],
+        output_field=FloatField(),
+    )
+    return (
+        StoreEntry.objects.filter(addr__in=addrs, **query_args)
+        .annotate(rank=ordering, score=score)
+        .order_by("rank")
+        .values(*fields, "score")[:max_count]
+    )
+
+
+def get_entry_list_by_vector(keywords, query_args, max_count, fields=None):
+    """
+    Semantic search: k-NN over the embedded blocks of the user, one row per addr
+    Return None if embedding is not available, the caller falls back to keyword search
+    """
+    emb_model, embedding = get_query_embedding(keywords)
+    if emb_model is None:
+        return None
+    if fields is None:
+        fields = DEFAULT_LIST_FIELDS
+    candidates = max_count * VECTOR_SEARCH_CANDIDATE_FACTOR
+    with transaction.atomic():
+        vector_index.set_search_params(get_vector_scan_size(len(embedding), candidates))
+        blocks = list(
+            get_vector_blocks(query_args, emb_model, embedding, candidates).values_list(
+                "addr", "distance"
+            )[:candidates]
+        )
+    addrs = []
+    scores = []
+    for addr, distance in blocks:  # ordered by distance, keep the best block of each addr
+        if addr not in addrs:
+            addrs.append(addr)
+            scores.append(1 - distance)
+        if len(addrs) >= max_count:
+            break
+    return get_entries_by_addrs(addrs, scores, query_args, max_count, fields)
+
+
+def get_fts_sql(keywords, query_args):
+    """
+    Full-text match over entries (title, abstract, tags, addr) and their blocks (content),
+    one row per addr with the best rank, ordered by rank
+    Return (None, None) if keywords has no searchable word
+    """
+    query = get_search_query(keywords)
+    if query is None:
+        return None, None
+    entries = (
+        StoreEntry.objects.filter(search_vector=query, **query_args)
+        .annotate(hit_addr=F("addr"), score=SearchRank(F("search_vector"), query))
+        .values("hit_addr", "score")
+        .order_by()
+    )
+    blocks = (
+        StoreBlock.objects.filter(search_vector=query, **get_block_args(query_args))
+        .annotate(hit_addr=F("entry__addr"), score=SearchRank(F("search_vector"), query))
+        .values("hit_addr", "score")
+        .order_by()
+    )
+    sql, params = entries.union(blocks, all=True).query.sql_with_params()
+    sql = (
+        f"SELECT hit_addr AS addr, max(score) AS score FROM ({sql}) u "
+        "GROUP BY hit_addr ORDER BY score DESC"
+    )
+    return sql, params
+
+
+def fts_search(keywords, query_args, max_count):
+    """
+    Return a list of {"addr", "score"}
+    """
+    sql, params = get_fts_sql(keywords, query_args)
+    if sql is None:
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(f"{sql} LIMIT %s", (*params, max_count))
+        return [{"addr": addr, "score": score} for addr, score in cursor.fetchall()]
+
+
+def get_hybrid_depth():
+    return int(os.getenv("HYBRID_SEARCH_DEPTH", HYBRID_SEARCH_DEPTH))
+
+
+def hybrid_search(keywords, query_args, max_count, depth=None, debug=False):
+    """
+    Full-text and vector retrieval in one statement, merged by reciprocal-rank fusion:
+        score = sum(1 / (RRF_K + rank)) over the lists an addr appears in
+    depth is the number of candidates taken from each list
+    Return a list of {"addr", "score", "fts_rank", "vec_rank"}
+    """
+    if depth is None:
+        depth = get_hybrid_depth()
+    depth = max(depth, max_count)
+    fts_sql, fts_params = get_fts_sql(keywords, query_args)
+    if fts_sql is not None:
+        fts_sql = f"{fts_sql} LIMIT %s"
+        fts_params = (*fts_params, depth)
+    else:  # no searchable word, vector only
+        fts_sql = "SELECT NULL::varchar AS addr, NULL::float AS score WHERE false"
+        fts_params = ()
+    emb_model, embedding = get_query_embedding(keywords)
+    if emb_model is not None:
+        candidates = depth * VECTOR_SEARCH_CANDIDATE_FACTOR
+        vec_qs = get_vector_blocks(query_args, emb_model, embedding, candidates).values(
+            "addr", "distance"
+        )[:candidates]
+        vec_sql, vec_params = vec_qs.query.sql_with_params()
+    else:  # keyword only, keep the statement shape
+        vec_sql = "SELECT NULL::varchar AS addr, NULL::float AS distance WHERE false"
+        vec_params = ()
+    sql = f"""
+        WITH fts AS (
+            SELECT addr, row_number() OVER (ORDER BY score DESC) AS rnk
+            FROM ({fts_sql}) f
+        ),
+        vec AS (
+            SELECT addr, row_number() OVER (ORDER BY min(distance)) AS rnk
+            FROM ({vec_sql}) v GROUP BY addr ORDER BY rnk LIMIT %s
+        )
+        SELECT coalesce(fts.addr, vec.addr),
+            coalesce(1.0 / (%s + fts.rnk), 0) + coalesce(1.0 / (%s + vec.rnk), 0) AS score,
+            fts.rnk, vec.rnk
+        FROM fts FULL OUTER JOIN vec ON fts.addr = vec.addr
+        ORDER BY score DESC LIMIT %s
+    """
+    params = (*fts_params, *vec_params, depth, RRF_K, RRF_K, max_count)
+    with transaction.atomic(), connection.cursor() as cursor:
+        if emb_model is not None:
+            vector_index.set_search_params(get_vector_scan_size(len(embedding), candidates))
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    if debug:
+        logger.debug(f"hybrid search {keywords}, emb_model {emb_model}, hits {len(rows)}")
+    return [
+        {"addr": addr, "score": float(score), "fts_rank": fts_rank, "vec_rank": vec_rank}
+        for addr, score, fts_rank, vec_rank in rows
+    ]
+
+
+def get_entry_list_by_hybrid(keywords, query_args, max_count, fields=None):
+    if fields is None:
+        fields = DEFAULT_LIST_FIELDS
+    hits = hybrid_search(keywords, query_args, max_count)
+    addrs = [hit["addr"] for hit in hits]
+    scores = [hit["score"] for hit in hits]
+    return get_entries_by_addrs(addrs, scores, query_args, max_count, fields)
+
+
+def get_entry_list(keywords, query_args, max_count, fields = None, search_mode=SEARCH_MODE_KEYWORD):
     query_args["is_deleted"] = False
     if fields is None:
-        fields = [
-            "idx",
-            "block_id",
-            "raw",
-            "title",
-            "etype",
-            "atype",
-            "ctype",
-            "status",
-            "addr",
-            "path",
-            "created_time",
-            "updated_time",
-        ]
+        fields = DEFAULT_LIST_FIELDS
+    if search_mode == SEARCH_MODE_VECTOR and keywords is not None and len(keywords) > 0:
+        queryset = get_entry_list_by_vector(keywords, query_args, max_count, fields)
+        if queryset is not None:
+            return queryset
+        logger.info("vector search not available, fall back to keyword search")
+    if search_mode == SEARCH_MODE_HYBRID and keywords is not None and len(keywords) > 0:
+        queryset = get_entry_list_by_hybrid(keywords, query_args, max_count, fields)
+        if len(queryset) > 0:
+            return queryset
+        logger.info("hybrid search found nothing, fall back to keyword search")
     if keywords is not None and len(keywords) > 0:
         keywords = regular_keyword(keywords)
-        keyword_arr = keywords.split(" ")
-        # find by title
-        q_obj = Q()
-        for keyword in keyword_arr:
-            q_obj &= Q(title__iregex=keyword)
-        queryset = StoreEntry.objects.filter(q_obj, **query_args).values(*fields)[:max_count]
-        
-        if len(queryset) == 0:
-            # find by raw
-            q_obj = Q()
-            for keyword in keyword_arr:
-                q_obj &= Q(raw__iregex=keyword)
-            query_args_2 = query_args.copy()
-            query_args_2.pop("block_id")
-            queryset = StoreEntry.objects.filter(q_obj, **query_args_2).values(*fields)
-            if len(queryset) > 0:
-                queryset = queryset.order_by("addr", "block_id").distinct("addr")[:max_count]
+        # find by full-text index, title is weighted above raw
+        hits = fts_search(keywords, query_args, max_count)
+        queryset = get_entries_by_addrs(
+            [hit["addr"] for hit in hits],
+            [hit["score"] for hit in hits],
+            query_args,
+            max_count,
+            fields,
+        )
 
         if len(queryset) == 0:
-            # find by title trigram
-            queryset = (
-                StoreEntry.objects.filter(**query_args)
+            # find by title trigram, the % operator is served by store_entry_title_trgm
+            matches = (
+                StoreEntry.objects.filter(title__trigram_similar=keywords, **query_args)
                 .annotate(
                     similarity=TrigramSimilarity("title", keywords),
                 )
-                .filter(similarity__gt=0.05)
                 .order_by("-similarity")[:max_count]
+            )
+            idxs = get_trigram_matches(matches, TRIGRAM_SIMILARITY_THRESHOLD)
+            ordering = Case(
+                *[When(idx=idx, then=pos) for pos, idx in enumerate(idxs)],
+                output_field=IntegerField(),
+            )
+            queryset = (
+                StoreEntry.objects.filter(idx__in=idxs)
+                .annotate(rank=ordering)
+                .order_by("rank")
                 .values(*fields)
             )
     else:
@@ -0,0 +1,49 @@
+"""
+Full-text search over StoreEntry.search_vector
+
+Postgres has no Chinese parser in the default image, so CJK text is segmented
+with jieba before to_tsvector, and the 'simple' config is used for all languages.
+Weights: title A, raw B, ctype (tags) C, addr D
+"""
+
+import re
+from django.db.models import Value
+from django.contrib.postgres.search import SearchVector, SearchQuery
+
+from backend.common.utils.text_tools import segment_text
+
+FTS_CONFIG = "simple"
+FTS_MAX_LENGTH = 100000  # tsvector is limited to 1MB
+TSQUERY_SPECIAL = re.compile(r"[&|!():*<>'\"\\\s]")
+
+
+def get_search_vector(title, raw, ctype=None, addr=None):
+    """
+    Expression to assign to search_vector, evaluated by the database on save/update
+    """
+    vector = None
+    for text, weight in [(title, "A"), (raw, "B"), (ctype, "C"), (addr, "D")]:
+        if text is None or len(text) == 0:
+            continue
+        item = SearchVector(
+            Value(segment_text(text[:FTS_MAX_LENGTH])), weight=weight, config=FTS_CONFIG
+        )
+        vector = item if vector is None else vector + item
+    return vector
+
+
+def get_search_query(keywords):
+    """
+    Prefix match of all words, e.g. 'py web' -> py:* & web:*
+    Return None if no word is left
+    """
+    if keywords is None:
+        return None
+    words = []
+    for word in segment_text(keywords).split(" "):
+        word = TSQUERY_SPECIAL.sub("", word)
+        if len(word) > 0:
+            words.append(f"{word}:*")
+    if len(words) == 0:
+        return None
+    return SearchQuery(" & ".join(words), config=FTS_CONFIG, search_type="raw")
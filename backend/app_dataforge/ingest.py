@@ -0,0 +1,297 @@
+"""
+Database-backed queue for file/note uploads
+
+The upload request only stores the files under INGEST_JOB_DIR and adds an IngestJob,
+'manage.py ingest_worker' claims pending jobs with SELECT ... FOR UPDATE SKIP LOCKED
+and runs add_data for every file. Items already done are skipped when a job is
+retried, and add_data itself replaces the entry of an addr, so retries are idempotent.
+A running job renews its lease (updated_time) every INGEST_HEARTBEAT_INTERVAL, a failed
+attempt is retried after INGEST_RETRY_DELAY, doubled every attempt. The stored files
+are removed when the job is done, files of failed jobs are kept for retry_job and
+removed by the worker INGEST_FAILED_KEEP_DAYS later.
+"""
+
+import os
+import time
+import uuid
+import shutil
+import socket
+import datetime
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from backend.common.files import filecache
+from backend.common.utils.file_tools import get_ext
+
+from .models import IngestJob
+from . import lease
+from .entry import add_data
+
+INGEST_JOB_DIR = "/tmp/ingest_jobs/"  # env INGEST_JOB_DIR, keep it on a volume to survive restarts
+INGEST_MAX_ATTEMPTS = 3  # env INGEST_MAX_ATTEMPTS
+INGEST_JOB_TIMEOUT = 600  # seconds without progress before a running job is claimed again
+INGEST_HEARTBEAT_INTERVAL = 60  # seconds between lease renewals of a running job
+INGEST_RETRY_DELAY = 30  # seconds before the first retry, env INGEST_RETRY_DELAY
+INGEST_POLL_INTERVAL = 2  # seconds
+INGEST_FAILED_KEEP_DAYS = 7  # files of failed jobs are kept for retry, env INGEST_FAILED_KEEP_DAYS
+INGEST_SWEEP_INTERVAL = 3600  # seconds between two sweeps of the job dir
+UPLOAD_WORKERS = 4  # files processed at the same time, env UPLOAD_WORKERS
+
+ITEM_PENDING = "pending"
+ITEM_DONE = "done"
+ITEM_FAILED = "failed"
+
+
+def use_async():
+    val = os.getenv("INGEST_ASYNC", "False")
+    return val.lower() == "true"
+
+
+def get_job_dir(job_id):
+    return os.path.join(os.getenv("INGEST_JOB_DIR", INGEST_JOB_DIR), str(job_id))
+
+
+def get_max_attempts():
+    return int(os.getenv("INGEST_MAX_ATTEMPTS", INGEST_MAX_ATTEMPTS))
+
+
+def get_retry_delay(attempts):
+    return int(os.getenv("INGEST_RETRY_DELAY", INGEST_RETRY_DELAY)) * 2 ** max(0, attempts - 1)
+
+
+def get_upload_workers():
+    return max(1, int(os.getenv("UPLOAD_WORKERS", UPLOAD_WORKERS)))
+
+
+def map_items(func, items, workers=None):
+    """
+    Run func on every item in a bounded thread pool, results keep the order of items
+    Parse/convert and the LLM/embedding requests of different files overlap
+    """
+    if workers is None:
+        workers = get_upload_workers()
+    workers = min(workers, len(items))
+    # threads use their own connections, they can't see the rows of an open transaction
+    if workers <= 1 or connection.in_atomic_block:
+        return [func(item) for item in items]
+
+    def run(item):
+        try:
+            return func(item)
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run, items))
+
+
+def save_upload(dic, file, addr, md5):
+    """
+    Process one uploaded file in the request, return its result
+    """
+    dic_item = dic.copy()
+    dic_item["addr"] = addr
+    dic_item["md5"] = md5
+    try:
+        with filecache.upload_tmpfile(file, get_ext(addr)) as tmp_path:
+            logger.debug(f"## save to db {tmp_path} len {file.size}")
+            ret, ret_emb, detail = add_data(dic_item, tmp_path)
+    except Exception as e:
+        traceback.print_exc()
+        ret, ret_emb, detail = False, False, str(e)
+    return {
+        "addr": addr,
+        "status": ITEM_DONE if ret else ITEM_FAILED,
+        "emb_status": "success" if ret_emb else "failed",
+        "detail": str(detail),
+    }
+
+
+def create_job(dic, files):
+    """
+    Store the uploaded files and queue them, files is a list of (UploadedFile, addr, md5)
+    """
+    job = IngestJob(user_id=dic["user_id"], args=dic)
+    job_dir = get_job_dir(job.idx)
+    os.makedirs(job_dir, exist_ok=True)
+    items = []
+    for idx, (file, addr, md5) in enumerate(files):
+        path = os.path.join(job_dir, f"{idx}{get_ext(addr)}")
+        filecache.write_upload(file, path)
+        items.append(
+            {"addr": addr, "md5": md5, "path": path, "status": ITEM_PENDING, "detail": None}
+        )
+    job.items = items
+    job.total = len(items)
+    job.save()
+    logger.info(f"ingest job {job.idx} queued, {job.total} files")
+    return job
+
+
+def claim_job(worker):
+    """
+    Take the oldest pending job, or a running one whose worker stopped reporting progress
+    """
+    now = timezone.now()
+    stale_time = now - datetime.timedelta(seconds=INGEST_JOB_TIMEOUT)
+    with transaction.atomic():
+        job = (
+            IngestJob.objects.select_for_update(skip_locked=True)
+            .filter(
+                Q(status=IngestJob.Status.PENDING)
+                & (Q(next_run_time__isnull=True) | Q(next_run_time__lte=now))
+                | Q(status=IngestJob.Status.RUNNING, updated_time__lt=stale_time)
+            )
+            .order_by("created_time")
+            .first()
+        )
+        if job is None:
+            return None
+        job.status = IngestJob.Status.RUNNING
+        job.worker = worker
+        job.attempts += 1
+        job.save(update_fields=["status", "worker", "attempts", "updated_time"])
+    return job
+
+
+def run_item(job, item):
+    dic = job.args.copy()
+    dic["addr"] = item["addr"]
+    dic["md5"] = item["md5"]
+    try:
+        if not os.path.exists(item["path"]):
+            return False, False, f"file lost {item['path']}"
+        # a retried job may have uploaded the file before it stopped
+        ret, ret_emb, detail = add_data(dic, item["path"], resume=job.attempts > 1)
+        return ret, ret_emb, str(detail)
+    except Exception as e:
+        traceback.print_exc()
+        return False, False, str(e)
+
+
+def run_job(job):
+    """
+    Process the items not done yet, UPLOAD_WORKERS at a time, progress is saved after every file
+    """
+    lock = threading.Lock()
+
+    def process(item):
+        ret, ret_emb, detail = run_item(job, item)
+        with lock:
+            item["status"] = ITEM_DONE if ret else ITEM_FAILED
+            item["emb_status"] = "success" if ret_emb else "failed"
+            item["detail"] = detail
+            job.finished = len([x for x in job.items if x["status"] == ITEM_DONE])
+            job.save(update_fields=["items", "finished", "updated_time"])
+
+    # a file may take longer than INGEST_JOB_TIMEOUT
+    with lease.keep_lease(job, INGEST_HEARTBEAT_INTERVAL):
+        map_items(process, [x for x in job.items if x["status"] != ITEM_DONE])
+
+    failed = [x for x in job.items if x["status"] == ITEM_FAILED]
+    if len(failed) == 0:
+        job.status = IngestJob.Status.DONE
+        job.error = None
+    elif job.attempts < get_max_attempts():
+        job.status = IngestJob.Status.PENDING
+        job.error = failed[0]["detail"]
+        delay = get_retry_delay(job.attempts)
+        job.next_run_time = timezone.now() + datetime.timedelta(seconds=delay)
+    else:
+        job.status = IngestJob.Status.FAILED
+        job.error = failed[0]["detail"]
+    job.save(update_fields=["status", "error", "next_run_time", "updated_time"])
+    if job.status == IngestJob.Status.DONE:  # files of failed jobs are kept for retry_job
+        shutil.rmtree(get_job_dir(job.idx), ignore_errors=True)
+    logger.info(f"ingest job {job.idx} {job.status}, {job.finished}/{job.total}")
+    return job
+
+
+def retry_job(job):
+    """
+    Queue a failed job again, only its failed files are processed
+    Return False if the job is not failed or its files are removed already (clear_failed_jobs)
+    """
+    if job.status != IngestJob.Status.FAILED:
+        return False
+    failed = [x for x in job.items if x["status"] == ITEM_FAILED]
+    if not all(os.path.exists(x["path"]) for x in failed):
+        return False
+    job.status = IngestJob.Status.PENDING
+    job.attempts = 0
+    job.next_run_time = None
+    job.save(update_fields=["status", "attempts", "next_run_time", "updated_time"])
+    return True
+
+
+def clear_failed_jobs():
+    """
+    Remove the files of jobs failed INGEST_FAILED_KEEP_DAYS ago, and of job dirs without a job
+    Only dirs still on disk are looked up, the sweep doesn't grow with the job table
+    """
+    root = os.getenv("INGEST_JOB_DIR", INGEST_JOB_DIR)
+    if not os.path.isdir(root):
+        return 0
+    days = int(os.getenv("INGEST_FAILED_KEEP_DAYS", INGEST_FAILED_KEEP_DAYS))
+    expire_time = timezone.now() - datetime.timedelta(days=days)
+    names = os.listdir(root)
+    jobs = {
+        str(idx): (status, updated_time)
+        for idx, status, updated_time in IngestJob.objects.filter(
+            idx__in=[x for x in names if is_uuid(x)]
+        ).values_list("idx", "status", "updated_time")
+    }
+    count = 0
+    for name in names:
+        path = os.path.join(root, name)
+        if name in jobs:
+            status, updated_time = jobs[name]
+            expired = status == IngestJob.Status.FAILED and updated_time < expire_time
+        else:  # the request stopped before the job was saved
+            expired = os.path.getmtime(path) < expire_time.timestamp()
+        if expired:
+            shutil.rmtree(path, ignore_errors=True)
+            count += 1
+    if count > 0:
+        logger.info(f"remove files of {count} failed ingest jobs")
+    return count
+
+
+def is_uuid(value):
+    try:
+        uuid.UUID(value)
+        return True
+    except ValueError:
+        return False
+
+
+def get_worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def run_worker(once=False, interval=INGEST_POLL_INTERVAL):
+    """
+    Worker loop, several workers can run at the same time
+    """
+    worker = get_worker_name()
+    logger.info(f"ingest worker {worker} started")
+    last_sweep = 0
+    while True:
+        if time.time() - last_sweep > INGEST_SWEEP_INTERVAL:
+            last_sweep = time.time()
+            try:
+                clear_failed_jobs()
+            except Exception as e:
+                logger.warning(f"clear failed ingest jobs failed {e}")
+        job = claim_job(worker)
+        if job is not None:
+            run_job(job)
+        elif once:
+            break
+        else:
+            time.sleep(interval)
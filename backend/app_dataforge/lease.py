@@ -0,0 +1,47 @@
+"""
+Lease of a queued job (IngestJob, BackfillJob) held by a worker
+
+A RUNNING job whose updated_time is older than the timeout of its queue is claimed
+again by another worker, keep_lease touches updated_time while the worker is busy
+with a step (a file, an embedding batch) that may take longer than that.
+"""
+
+import threading
+from contextlib import contextmanager
+from django.db import connection
+from django.utils import timezone
+
+HEARTBEAT_INTERVAL = 60  # seconds, well below the job timeouts
+
+
+def renew_lease(job, stop, interval):
+    """
+    Touch updated_time until stop is set, only while the job is still ours
+    """
+    model = type(job)
+    try:
+        while not stop.wait(interval):
+            model.objects.filter(
+                idx=job.idx, status=model.Status.RUNNING, worker=job.worker
+            ).update(updated_time=timezone.now())
+    finally:
+        connection.close()
+
+
+@contextmanager
+def keep_lease(job, interval=HEARTBEAT_INTERVAL):
+    """
+    with keep_lease(job): ..., renew the lease of job in a thread until the block exits
+    """
+    stop = threading.Event()
+    heartbeat = None
+    # the thread has its own connection, it would wait for the row locked by an open transaction
+    if not connection.in_atomic_block:
+        heartbeat = threading.Thread(target=renew_lease, args=(job, stop, interval), daemon=True)
+        heartbeat.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        if heartbeat is not None:
+            heartbeat.join()
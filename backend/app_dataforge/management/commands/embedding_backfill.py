@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from backend.common.llm.llm_hub import EmbeddingTools
+from app_dataforge import backfill
+from app_dataforge.models import StoreEntry
+
+
+class Command(BaseCommand):
+    help = "Re-embed stale chunks in the background (BackfillJob)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--queue",
+            action="store_true",
+            help="first queue a job for --user, or for every user when it is not given",
+        )
+        parser.add_argument("--user", default=None)
+        parser.add_argument(
+            "--once", action="store_true", help="exit when the queue is empty"
+        )
+        parser.add_argument("--interval", type=float, default=backfill.BACKFILL_POLL_INTERVAL)
+
+    def handle(self, *args, **options):
+        if options["queue"]:
+            emb_model = EmbeddingTools.get_model_name(EmbeddingTools.use_embedding())
+            if emb_model is None:
+                raise CommandError("no embedding model")
+            users = [options["user"]]
+            if options["user"] is None:
+                users = (
+                    StoreEntry.objects.filter(user_id__isnull=False)
+                    .values_list("user_id", flat=True)
+                    .distinct()
+                    .order_by()
+                )
+            for user_id in users:
+                job = backfill.create_job(user_id, emb_model)
+                self.stdout.write(f"{user_id}\t{job.idx}\t{job.total}")
+        backfill.run_worker(once=options["once"], interval=options["interval"])
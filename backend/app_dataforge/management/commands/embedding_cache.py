@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from app_dataforge import emb_cache
+
+
+class Command(BaseCommand):
+    help = "Show hit rate of the embedding cache, or remove old vectors"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--prune", type=int, default=None, metavar="DAYS", help="remove vectors not used for DAYS"
+        )
+        parser.add_argument(
+            "--clear", action="store_true", help="remove all vectors, or those of --model"
+        )
+        parser.add_argument("--model", default=None, help="only this emb_model")
+
+    def handle(self, *args, **options):
+        if options["prune"] is not None or options["clear"]:
+            days = None if options["clear"] else options["prune"]
+            count = emb_cache.prune(days, emb_model=options["model"])
+            self.stdout.write(f"removed {count} vectors")
+        for row in emb_cache.get_stats():
+            self.stdout.write(f"{row['emb_model']}\t{row['rows']}\t{row['hits']}\t{row['hit_rate']}")
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from backend.common.files import filecache
+
+
+class Command(BaseCommand):
+    help = "Show counters of the temp/download file cache, or clean it now"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--clear", action="store_true", help="remove expired files and evict over the size limit"
+        )
+
+    def handle(self, *args, **options):
+        manager = filecache.TmpFileManager.get_instance()
+        if options["clear"]:
+            manager.clear(force=True)
+        for key, value in manager.get_stats().items():
+            self.stdout.write(f"{key}\t{value}")
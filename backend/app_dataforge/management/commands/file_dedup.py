@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from backend.common.files import utils_filemanager
+
+
+class Command(BaseCommand):
+    help = "Link the files of the local store to content-addressed blobs (LOCAL_FILE_DEDUP)"
+
+    def handle(self, *args, **options):
+        manager = utils_filemanager.get_file_manager()
+        if not isinstance(manager, utils_filemanager.LocalFileManager) or not manager.dedup:
+            raise CommandError("needs FILE_STORE=local and LOCAL_FILE_DEDUP=True")
+        count, saved = manager.dedup_files()
+        self.stdout.write(f"file_dedup done, {count} files, {saved} bytes saved")
@@ -0,0 +1,33 @@
+import multiprocessing
+from django.db import connections
+from django.core.management.base import BaseCommand
+
+from app_dataforge import ingest
+
+
+class Command(BaseCommand):
+    help = "Process queued uploads (IngestJob)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=1, help="worker processes")
+        parser.add_argument(
+            "--once", action="store_true", help="exit when the queue is empty"
+        )
+        parser.add_argument("--interval", type=float, default=ingest.INGEST_POLL_INTERVAL)
+
+    def handle(self, *args, **options):
+        if options["workers"] <= 1:
+            ingest.run_worker(once=options["once"], interval=options["interval"])
+            return
+        connections.close_all()  # every process opens its own connection
+        processes = [
+            multiprocessing.Process(
+                target=ingest.run_worker,
+                kwargs={"once": options["once"], "interval": options["interval"]},
+            )
+            for idx in range(options["workers"])
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
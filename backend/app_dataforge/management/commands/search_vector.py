@@ -0,0 +1,58 @@
+from django.db.models import Value
+from django.contrib.postgres.search import SearchVector
+from django.core.management.base import BaseCommand
+
+from app_dataforge.models import StoreEntry, StoreBlock
+from app_dataforge.fts import get_search_vector, FTS_CONFIG
+
+
+class Command(BaseCommand):
+    help = "Fill search_vector of store_entry and store_block rows saved before the full-text column existed"
+
+    # rows without text get an empty vector, so they are not selected again on the next start
+    EMPTY_VECTOR = SearchVector(Value(""), config=FTS_CONFIG)
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch", type=int, default=500)
+        parser.add_argument(
+            "--all", action="store_true", help="recompute every row, not only empty ones"
+        )
+
+    def update_rows(self, model, fields, get_vector, batch_size, update_all):
+        queryset = model.objects.all()
+        if not update_all:
+            queryset = queryset.filter(search_vector__isnull=True)
+        rows = queryset.order_by("pk").values_list("pk", *fields)
+        count = 0
+        last_pk = None
+        while True:
+            batch = rows if last_pk is None else rows.filter(pk__gt=last_pk)
+            batch = list(batch[:batch_size])
+            if len(batch) == 0:
+                break
+            for pk, *values in batch:
+                vector = get_vector(*values)
+                if vector is None:
+                    vector = Command.EMPTY_VECTOR
+                model.objects.filter(pk=pk).update(search_vector=vector)
+            last_pk = batch[-1][0]
+            count += len(batch)
+            self.stdout.write(f"{model._meta.db_table} updated {count}")
+        return count
+
+    def handle(self, *args, **options):
+        count = self.update_rows(
+            StoreEntry,
+            ["title", "raw", "ctype", "addr"],
+            get_search_vector,
+            options["batch"],
+            options["all"],
+        )
+        count += self.update_rows(
+            StoreBlock,
+            ["raw"],
+            lambda raw: get_search_vector(None, raw),
+            options["batch"],
+            options["all"],
+        )
+        self.stdout.write(f"search_vector done, {count} rows")
@@ -0,0 +1,57 @@
+from django.db import transaction
+from django.core.management.base import BaseCommand
+
+from app_dataforge import vector_index
+from app_dataforge.models import StoreEntry, StoreBlock
+from app_dataforge.fts import get_search_vector
+from backend.common.parser.utils_md import get_text_md5
+
+
+class Command(BaseCommand):
+    help = "Move legacy chunk rows (store_entry.block_id > 0) into store_block"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch", type=int, default=500)
+
+    def handle(self, *args, **options):
+        chunks = StoreEntry.objects.filter(block_id__gt=0).order_by("user_id", "addr", "block_id")
+        parents = {}
+        moved = 0
+        orphans = 0
+        while True:
+            batch = list(chunks[: options["batch"]])
+            if len(batch) == 0:
+                break
+            blocks = []
+            for chunk in batch:
+                key = (chunk.user_id, chunk.addr)
+                if key not in parents:
+                    parents[key] = (
+                        StoreEntry.objects.filter(user_id=chunk.user_id, addr=chunk.addr, block_id=0)
+                        .order_by("-updated_time")
+                        .first()
+                    )
+                if parents[key] is None:
+                    orphans += 1
+                    continue
+                blocks.append(
+                    StoreBlock(
+                        entry=parents[key],
+                        ordinal=chunk.block_id,
+                        raw=chunk.raw,
+                        md5=get_text_md5(chunk.raw) if chunk.raw is not None else None,
+                        embeddings=chunk.embeddings,
+                        emb_model=chunk.emb_model,
+                        search_vector=get_search_vector(None, chunk.raw),
+                    )
+                )
+            with transaction.atomic():
+                StoreBlock.objects.bulk_create(blocks, ignore_conflicts=True)
+                StoreEntry.objects.filter(idx__in=[chunk.idx for chunk in batch]).delete()
+            moved += len(blocks)
+            self.stdout.write(f"moved {moved} blocks, {orphans} orphan rows dropped")
+        if moved == 0 and orphans == 0 and not vector_index.has_legacy_indexes():
+            return  # run at every start by init_django, nothing left to do
+        vector_index.drop_legacy_indexes()
+        created = vector_index.sync_indexes()
+        self.stdout.write(f"split_blocks done, {moved} blocks, vector indexes {created}")
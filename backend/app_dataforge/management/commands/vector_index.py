@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from app_dataforge import vector_index
+
+
+class Command(BaseCommand):
+    help = (
+        "Keep one ANN index per (emb_model, dimension) on store_block.embeddings, "
+        "run it again after changing VECTOR_INDEX_TYPE/VECTOR_INDEX_DIMENSIONS to convert them"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--method",
+            choices=[vector_index.INDEX_METHOD_HNSW, vector_index.INDEX_METHOD_IVFFLAT],
+            default=None,
+            help="index method, default from env VECTOR_INDEX_METHOD",
+        )
+        parser.add_argument(
+            "--rebuild", action="store_true", help="drop and recreate all indexes"
+        )
+        parser.add_argument(
+            "--list", action="store_true", help="only show embedding groups and indexes"
+        )
+
+    def handle(self, *args, **options):
+        if options["list"]:
+            sizes = vector_index.get_index_sizes()
+            for (model, dim), count in vector_index.get_embedding_groups().items():
+                name = vector_index.get_index_name(model, dim)
+                flag = f"indexed {sizes[name]}" if name in sizes else "missing"
+                self.stdout.write(f"{model}\t{dim}\t{count}\t{name}\t{flag}")
+            return
+        created = vector_index.sync_indexes(
+            method=options["method"], rebuild=options["rebuild"], debug=True
+        )
+        self.stdout.write(f"created {len(created)} vector indexes: {created}")
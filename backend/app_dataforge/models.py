@@ -1,7 +1,12 @@
 from django.db import models
+from django.db.models import Q
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from pgvector.django import VectorField
 import uuid
 
+from .fts import get_search_vector
+
 
 class StoreEntry(models.Model):
     class EntryType(models.TextChoices):
@@ -16,6 +21,8 @@ class StoreEntry(models.Model):
     )
     user_id = models.CharField(max_length=128, null=True, blank=True)
 
+    # legacy: chunks live in StoreBlock, rows with block_id > 0 are moved by 'manage.py split_blocks',
+    # which init_django runs after migrate, so entry queries never see them
     embeddings = VectorField(dimensions=None, default=None, null=True)
     emb_model = models.CharField(max_length=64, null=True, blank=True)
     block_id = models.IntegerField(default=0)
@@ -51,10 +58,225 @@ class StoreEntry(models.Model):
     is_deleted = models.BooleanField(default=False)
     created_time = models.DateTimeField()
     updated_time = models.DateTimeField(auto_now=True, null=True, blank=True)
+    search_vector = SearchVectorField(null=True, editable=False)  # see fts.py
 
     class Meta:
         db_table = "store_entry"
         ordering = ["-updated_time"]
+        indexes = [
+            # split_blocks at every start, the legacy rows are found without a table scan
+            models.Index(fields=["block_id"], name="store_entry_legacy_block", condition=Q(block_id__gt=0)),
+            GinIndex(fields=["search_vector"], name="store_entry_search_gin"),
+            # pg_trgm, serve the % lookup of the title and the icontains fallback of bookmarks
+            GinIndex(fields=["title"], name="store_entry_title_trgm", opclasses=["gin_trgm_ops"]),
+            GinIndex(fields=["addr"], name="store_entry_addr_trgm", opclasses=["gin_trgm_ops"]),
+            GinIndex(fields=["ctype"], name="store_entry_ctype_trgm", opclasses=["gin_trgm_ops"]),
+            # save/delete/regenerate by addr
+            models.Index(fields=["user_id", "addr"], name="store_entry_user_addr"),
+            # backfill jobs walk the entries of a user by idx
+            models.Index(fields=["user_id", "idx"], name="store_entry_user_idx"),
+            # entry list, ordered by Meta.ordering
+            models.Index(
+                fields=["user_id", "-updated_time"],
+                name="store_entry_list",
+                condition=Q(is_deleted=False),
+            ),
+            # sync compare/check_update, addr__startswith=vault
+            models.Index(
+                fields=["user_id", "etype", "addr"],
+                name="store_entry_sync",
+                opclasses=["varchar_pattern_ops"] * 3,
+            ),
+            # bookmark tree, navigation, search and folders
+            models.Index(
+                fields=["user_id", "source", "status"],
+                name="store_entry_source",
+                condition=Q(is_deleted=False),
+            ),
+            # readlater
+            models.Index(
+                fields=["user_id", "etype", "status", "-created_time"],
+                name="store_entry_status",
+                condition=Q(is_deleted=False),
+            ),
+            # chat sessions
+            models.Index(fields=["user_id", "etype", "-updated_time"], name="store_entry_recent"),
+        ]
 
     def __str__(self):
         return self.title[:30]
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        fts_fields = {"title", "raw", "ctype", "addr"}
+        if update_fields is None or fts_fields & set(update_fields):
+            self.search_vector = get_search_vector(self.title, self.raw, self.ctype, self.addr)
+            if update_fields is not None:
+                kwargs["update_fields"] = set(update_fields) | {"search_vector"}
+        super().save(*args, **kwargs)
+        if hasattr(self.search_vector, "resolve_expression"):
+            self.search_vector = None  # evaluated by the database, not loaded back
+
+
+class StoreBlock(models.Model):
+    """
+    Text chunk of a StoreEntry, split for embedding and content search
+    """
+
+    entry = models.ForeignKey(StoreEntry, on_delete=models.CASCADE, related_name="blocks")
+    ordinal = models.IntegerField()  # 1, 2, ...
+    raw = models.TextField(null=True, blank=True)
+    embeddings = VectorField(dimensions=None, default=None, null=True)
+    emb_model = models.CharField(max_length=64, null=True, blank=True)
+    md5 = models.CharField(max_length=32, default=None, null=True, blank=True)  # md5 of raw
+    search_vector = SearchVectorField(null=True, editable=False)  # see fts.py
+
+    class Meta:
+        db_table = "store_block"
+        ordering = ["entry_id", "ordinal"]
+        constraints = [
+            models.UniqueConstraint(fields=["entry", "ordinal"], name="store_block_entry_ordinal"),
+        ]
+        indexes = [
+            GinIndex(fields=["search_vector"], name="store_block_search_gin"),
+            # reuse the vector of an identical chunk
+            models.Index(
+                fields=["md5", "emb_model"],
+                name="store_block_md5",
+                condition=Q(embeddings__isnull=False),
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.entry_id}:{self.ordinal}"
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None or "raw" in update_fields:
+            self.search_vector = get_search_vector(None, self.raw)
+            if update_fields is not None:
+                kwargs["update_fields"] = set(update_fields) | {"search_vector"}
+        super().save(*args, **kwargs)
+        if hasattr(self.search_vector, "resolve_expression"):
+            self.search_vector = None
+
+
+class IngestJob(models.Model):
+    """
+    Queued upload, processed by 'manage.py ingest_worker', see ingest.py
+    """
+
+    class Status(models.TextChoices):
+        PENDING = "pending"
+        RUNNING = "running"
+        DONE = "done"
+        FAILED = "failed"
+
+    idx = models.UUIDField(
+        unique=True, primary_key=True, default=uuid.uuid4, editable=False
+    )
+    user_id = models.CharField(max_length=128)
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.PENDING)
+    args = models.JSONField(default=dict)  # common fields of the entries, etype, source...
+    items = models.JSONField(default=list)  # one per file: addr, md5, path, status, detail
+    total = models.IntegerField(default=0)
+    finished = models.IntegerField(default=0)
+    attempts = models.IntegerField(default=0)
+    worker = models.CharField(max_length=128, null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    next_run_time = models.DateTimeField(null=True, blank=True)  # retry delay of a failed attempt
+    created_time = models.DateTimeField(auto_now_add=True)
+    updated_time = models.DateTimeField(auto_now=True)  # heartbeat while running
+
+    class Meta:
+        db_table = "ingest_job"
+        ordering = ["-created_time"]
+        indexes = [
+            # worker poll, oldest job first
+            models.Index(
+                fields=["status", "created_time"],
+                name="ingest_job_queue",
+                condition=Q(status__in=["pending", "running"]),
+            ),
+            models.Index(fields=["user_id", "-created_time"], name="ingest_job_user"),
+        ]
+
+    def __str__(self):
+        return f"{self.idx}:{self.status} {self.finished}/{self.total}"
+
+
+class EmbeddingCache(models.Model):
+    """
+    Vector of a text for an embedding model, shared by all users, see emb_cache.py
+    """
+
+    emb_model = models.CharField(max_length=64)
+    text_hash = models.CharField(max_length=64)  # md5 of the text, as StoreBlock.md5
+    embeddings = VectorField(dimensions=None)
+    hits = models.IntegerField(default=0)
+    created_time = models.DateTimeField(auto_now_add=True)
+    last_used = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = "embedding_cache"
+        constraints = [
+            models.UniqueConstraint(fields=["emb_model", "text_hash"], name="embedding_cache_key"),
+        ]
+        indexes = [
+            models.Index(fields=["last_used"], name="embedding_cache_last_used"),
+        ]
+
+    def __str__(self):
+        return f"{self.emb_model}:{self.text_hash}"
+
+
+class BackfillJob(models.Model):
+    """
+    Re-embed the stale chunks of a user, processed by 'manage.py embedding_backfill', see backfill.py
+    """
+
+    class Status(models.TextChoices):
+        PENDING = "pending"
+        RUNNING = "running"
+        DONE = "done"
+        FAILED = "failed"
+
+    idx = models.UUIDField(
+        unique=True, primary_key=True, default=uuid.uuid4, editable=False
+    )
+    user_id = models.CharField(max_length=128)
+    emb_model = models.CharField(max_length=64)  # target model
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.PENDING)
+    cursor = models.UUIDField(null=True, blank=True)  # idx of the last entry done
+    total = models.IntegerField(default=0)  # stale chunks when the job started
+    finished = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    attempts = models.IntegerField(default=0)
+    worker = models.CharField(max_length=128, null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    next_run_time = models.DateTimeField(null=True, blank=True)  # retry delay of a failed pass
+    created_time = models.DateTimeField(auto_now_add=True)
+    updated_time = models.DateTimeField(auto_now=True)  # heartbeat while running
+
+    class Meta:
+        db_table = "backfill_job"
+        ordering = ["-created_time"]
+        indexes = [
+            models.Index(
+                fields=["status", "created_time"],
+                name="backfill_job_queue",
+                condition=Q(status__in=["pending", "running"]),
+            ),
+            models.Index(fields=["user_id", "-created_time"], name="backfill_job_user"),
+        ]
+        constraints = [
+            # one queued or running backfill per user and model
+            models.UniqueConstraint(
+                fields=["user_id", "emb_model"],
+                condition=Q(status__in=["pending", "running"]),
+                name="backfill_job_active",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.idx}:{self.status} {self.finished}/{self.total}"
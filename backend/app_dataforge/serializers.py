@@ -1,9 +1,10 @@
 from rest_framework import serializers
-from .models import StoreEntry
+from .models import StoreEntry, IngestJob
 
 class ListSerializer(serializers.ModelSerializer):
     updated_time = serializers.DateTimeField(format="%Y-%m-%d")
     created_time = serializers.DateTimeField(format="%Y-%m-%d")
+    score = serializers.FloatField(read_only=True)  # only set by vector/hybrid search
 
     class Meta:
         model = StoreEntry
@@ -21,6 +22,7 @@ class ListSerializer(serializers.ModelSerializer):
             "path",
             "updated_time",
             "created_time",
+            "score",
         ]
 
     #def get_type(self, obj):
@@ -32,7 +34,40 @@ class DetailSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = StoreEntry
-        fields = '__all__'
+        exclude = ["search_vector"]
 
     #def get_type(self, obj):
-    #    return obj.get_type_display()
\ No newline at end of file
+    #    return obj.get_type_display()
+
+
+class IngestJobSerializer(serializers.ModelSerializer):
+    progress = serializers.SerializerMethodField()
+
+    class Meta:
+        model = IngestJob
+        fields = [
+            "idx",
+            "status",
+            "total",
+            "finished",
+            "progress",
+            "attempts",
+            "error",
+            "next_run_time",
+            "items",
+            "created_time",
+            "updated_time",
+        ]
+
+    def get_progress(self, obj):
+        if obj.total == 0:
+            return 1.0
+        return obj.finished / obj.total
+
+    def to_representation(self, obj):
+        data = super().to_representation(obj)
+        # local paths stay on the server
+        data["items"] = [
+            {k: v for k, v in item.items() if k != "path"} for item in data["items"]
+        ]
+        return data
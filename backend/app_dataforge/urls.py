@@ -1,10 +1,11 @@
 from rest_framework.routers import DefaultRouter
 from rest_framework.documentation import include_docs_urls
 from django.urls import path, include
-from .views import StoreEntryViewSet, EntryAPIView
+from .views import StoreEntryViewSet, EntryAPIView, IngestJobViewSet
 
 router = DefaultRouter()
 router.register("data", StoreEntryViewSet)
+router.register("job", IngestJobViewSet, basename="job")
 
 urlpatterns = [
     path("", include(router.urls)),
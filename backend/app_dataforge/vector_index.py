@@ -0,0 +1,255 @@
+"""
+Manage ANN indexes over StoreBlock.embeddings
+
+Rows of different emb_model have different dimensions, a single index over the
+column is impossible, so keep one partial expression index per (emb_model, dimension):
+
+    CREATE INDEX ... ON store_block USING hnsw ((embeddings::vector(dim)) vector_cosine_ops)
+    WHERE emb_model = '...' AND vector_dims(embeddings) = dim
+
+Queries must use the same cast and predicates to be served by the index,
+see get_vector_blocks in entry.py, and run in a transaction after set_search_params,
+the default scan depth (hnsw.ef_search 40, ivfflat.probes 1) returns short lists
+
+The index can be built over a compact copy of the vectors, halfvec (VECTOR_INDEX_TYPE)
+and/or the first VECTOR_INDEX_DIMENSIONS components (for models trained to be truncated,
+e.g. text-embedding-3), the table keeps the full vectors to rerank the candidates:
+
+    USING hnsw ((subvector(embeddings::vector(dim), 1, k)::vector(k))::halfvec(k)) halfvec_cosine_ops)
+"""
+
+import os
+import hashlib
+from loguru import logger
+from django.db import connection
+from django.db.models import Func
+from django.db.models.functions import Cast
+from pgvector.django import VectorField, HalfVectorField, HalfVector
+
+from .models import StoreBlock
+
+INDEX_PREFIX = "store_block_emb_"
+LEGACY_INDEX_PREFIX = "store_entry_emb_"  # before chunks moved to store_block
+INDEX_METHOD_HNSW = "hnsw"
+INDEX_METHOD_IVFFLAT = "ivfflat"
+INDEX_TYPE_VECTOR = "vector"
+INDEX_TYPE_HALFVEC = "halfvec"  # needs pgvector >= 0.7
+MAX_INDEX_DIMENSIONS = {INDEX_TYPE_VECTOR: 2000, INDEX_TYPE_HALFVEC: 4000}  # pgvector limits for hnsw/ivfflat
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 64
+IVFFLAT_ROWS_PER_LIST = 1000
+HNSW_EF_SEARCH = 40  # minimum, env VECTOR_HNSW_EF_SEARCH
+HNSW_MAX_EF_SEARCH = 1000  # pgvector limit
+IVFFLAT_PROBES = 10  # minimum, env VECTOR_IVFFLAT_PROBES
+
+
+def get_index_method():
+    method = os.getenv("VECTOR_INDEX_METHOD", INDEX_METHOD_HNSW).lower()
+    if method not in [INDEX_METHOD_HNSW, INDEX_METHOD_IVFFLAT]:
+        logger.warning(f"unknown vector index method {method}, use {INDEX_METHOD_HNSW}")
+        method = INDEX_METHOD_HNSW
+    return method
+
+
+def get_index_type():
+    index_type = os.getenv("VECTOR_INDEX_TYPE", INDEX_TYPE_VECTOR).lower()
+    if index_type not in MAX_INDEX_DIMENSIONS:
+        logger.warning(f"unknown vector index type {index_type}, use {INDEX_TYPE_VECTOR}")
+        index_type = INDEX_TYPE_VECTOR
+    return index_type
+
+
+def get_index_dims(dim):
+    """
+    Dimensions kept in the index, 0 or empty VECTOR_INDEX_DIMENSIONS keeps all
+    """
+    reduced = int(os.getenv("VECTOR_INDEX_DIMENSIONS") or 0)
+    if reduced > 0:
+        return min(dim, reduced)
+    return dim
+
+
+def is_compact(dim):
+    return get_index_type() != INDEX_TYPE_VECTOR or get_index_dims(dim) < dim
+
+
+def get_index_sql(dim):
+    """
+    Indexed expression and operator class, get_index_expression is the same in the ORM
+    """
+    index_type = get_index_type()
+    reduced = get_index_dims(dim)
+    expression = f"embeddings::vector({dim})"
+    if reduced < dim:
+        expression = f"(subvector({expression}, 1, {reduced}))::vector({reduced})"
+    if index_type == INDEX_TYPE_HALFVEC:
+        expression = f"({expression})::halfvec({reduced})"
+    return expression, f"{index_type}_cosine_ops"
+
+
+def get_index_expression(dim):
+    index_type = get_index_type()
+    reduced = get_index_dims(dim)
+    expression = Cast("embeddings", VectorField(dimensions=dim))
+    if reduced < dim:
+        expression = Cast(
+            Func(expression, function="subvector", template=f"%(function)s(%(expressions)s, 1, {reduced})"),
+            VectorField(dimensions=reduced),
+        )
+    if index_type == INDEX_TYPE_HALFVEC:
+        expression = Cast(expression, HalfVectorField(dimensions=reduced))
+    return expression
+
+
+def get_query_vector(embedding):
+    """
+    The query embedding in the form of the indexed expression
+    """
+    vector = list(embedding[: get_index_dims(len(embedding))])
+    if get_index_type() == INDEX_TYPE_HALFVEC:
+        return HalfVector(vector)
+    return vector
+
+
+def set_search_params(limit):
+    """
+    Let the index scan return limit rows: hnsw stops after ef_search rows and ivfflat only
+    reads probes lists, rows of other users are dropped after the scan
+    SET LOCAL lasts until the end of the transaction, call it inside transaction.atomic()
+    """
+    ef_search = max(limit, int(os.getenv("VECTOR_HNSW_EF_SEARCH", HNSW_EF_SEARCH)))
+    ef_search = min(ef_search, HNSW_MAX_EF_SEARCH)
+    probes = max(
+        -(-limit // IVFFLAT_ROWS_PER_LIST), int(os.getenv("VECTOR_IVFFLAT_PROBES", IVFFLAT_PROBES))
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(f"SET LOCAL hnsw.ef_search = {ef_search}")
+        cursor.execute(f"SET LOCAL ivfflat.probes = {probes}")
+
+
+def get_index_name(emb_model, dim):
+    model_hash = hashlib.md5(emb_model.encode("utf-8")).hexdigest()[:8]
+    name = f"{INDEX_PREFIX}{model_hash}_{dim}"
+    # another name for every layout, sync_indexes replaces the indexes when the setting changes
+    if get_index_dims(dim) < dim:
+        name += f"_k{get_index_dims(dim)}"
+    if get_index_type() == INDEX_TYPE_HALFVEC:
+        name += "_h"
+    return name
+
+
+def quote_literal(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+def get_embedding_groups():
+    """
+    Return {(emb_model, dim): row count} of the embedded blocks
+    """
+    table = StoreBlock._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT emb_model, vector_dims(embeddings), count(*) FROM {table} "
+            "WHERE embeddings IS NOT NULL AND emb_model IS NOT NULL "
+            "GROUP BY 1, 2"
+        )
+        return {(row[0], row[1]): row[2] for row in cursor.fetchall()}
+
+
+def get_existing_indexes():
+    table = StoreBlock._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT indexname FROM pg_indexes WHERE tablename = %s AND indexname LIKE %s",
+            [table, INDEX_PREFIX + "%"],
+        )
+        return set(row[0] for row in cursor.fetchall())
+
+
+def get_index_sizes():
+    """
+    Return {index name: bytes on disk}
+    """
+    table = StoreBlock._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT indexname, pg_relation_size(quote_ident(indexname)::regclass) FROM pg_indexes "
+            "WHERE tablename = %s AND indexname LIKE %s",
+            [table, INDEX_PREFIX + "%"],
+        )
+        return {row[0]: row[1] for row in cursor.fetchall()}
+
+
+def get_legacy_indexes():
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT indexname FROM pg_indexes WHERE indexname LIKE %s",
+            [LEGACY_INDEX_PREFIX + "%"],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def has_legacy_indexes():
+    return len(get_legacy_indexes()) > 0
+
+
+def drop_legacy_indexes():
+    for name in get_legacy_indexes():
+        drop_index(name)
+
+
+def create_index(emb_model, dim, count, method=None):
+    if method is None:
+        method = get_index_method()
+    max_dims = MAX_INDEX_DIMENSIONS[get_index_type()]
+    if get_index_dims(dim) > max_dims:
+        logger.warning(f"skip vector index {emb_model}, dimension {get_index_dims(dim)} > {max_dims}")
+        return False
+    table = StoreBlock._meta.db_table
+    name = get_index_name(emb_model, dim)
+    expression, opclass = get_index_sql(dim)
+    if method == INDEX_METHOD_IVFFLAT:
+        lists = max(1, count // IVFFLAT_ROWS_PER_LIST)
+        options = f"WITH (lists = {lists})"
+    else:
+        options = f"WITH (m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION})"
+    sql = (
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} "
+        f"USING {method} (({expression}) {opclass}) {options} "
+        f"WHERE emb_model = {quote_literal(emb_model)} AND vector_dims(embeddings) = {dim}"
+    )
+    logger.info(f"create vector index {name} for {emb_model}, dim {dim}, rows {count}")
+    with connection.cursor() as cursor:
+        cursor.execute(sql)
+    return True
+
+
+def drop_index(name):
+    logger.info(f"drop vector index {name}")
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+
+def sync_indexes(method=None, rebuild=False, debug=False):
+    """
+    Create missing indexes, drop indexes of models no longer in use,
+    rebuild: drop and recreate all indexes, e.g. after regenerating embeddings
+    """
+    groups = get_embedding_groups()
+    existing = get_existing_indexes()
+    wanted = {get_index_name(model, dim): (model, dim) for model, dim in groups}
+    if debug:
+        logger.debug(f"vector groups {groups}, existing indexes {existing}")
+    dropped = set()
+    for name in existing:
+        if name not in wanted or rebuild:
+            drop_index(name)
+            dropped.add(name)
+    existing = existing - dropped
+    created = []
+    for name, (model, dim) in wanted.items():
+        if name in existing:
+            continue
+        if create_index(model, dim, groups[(model, dim)], method):
+            created.append(name)
+    return created
@@ -1,13 +1,13 @@
 import os
 import traceback
 import datetime
+from urllib.parse import quote
 from loguru import logger
-from wsgiref.util import FileWrapper
 
 from django.conf import settings
 from django.utils.encoding import smart_str
 from django.utils.translation import gettext as _
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse, Http404
 from rest_framework import viewsets
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
@@ -19,15 +19,17 @@ from knox.auth import TokenAuthentication
 
 from backend.common.files import utils_filemanager, filecache
 from backend.common.user.utils import parse_common_args, get_user_id
-from backend.common.utils.net_tools import do_result, get_backend_addr
+from backend.common.utils.net_tools import do_result, get_backend_addr, parse_range
 from backend.common.utils.web_tools import get_url_content
 from backend.common.utils.file_tools import get_content_type, get_ext
 from backend.common.parser.converter import convert, is_support
 
 from .feature import EntryFeatureTool
 from .entry import delete_entry, add_data, get_entry_list, get_type_options, rename_file
-from .models import StoreEntry
-from .serializers import ListSerializer, DetailSerializer
+from .entry import SEARCH_MODE_KEYWORD
+from .models import StoreEntry, IngestJob
+from .serializers import ListSerializer, DetailSerializer, IngestJobSerializer
+from . import ingest
 
 
 class StoreEntryViewSet(viewsets.ModelViewSet):
@@ -81,30 +83,33 @@ class StoreEntryViewSet(viewsets.ModelViewSet):
                 success_list = []
                 if len(files) > 0 and len(filemd5s) == 0:
                     filemd5s = [None] * len(files)
-                emb_status = "success"
+                paths = []
+                uploads = []
                 for file, addr, md5 in zip(files, filepaths, filemd5s):
                     if addr.startswith("/"):
                         addr = addr[1:]
-                    dic_item = dic.copy()
+                    paths.append(addr)
                     if vault is not None:
-                        dic_item["addr"] = os.path.join(vault, addr)
-                    else:
-                        dic_item["addr"] = addr
-                    dic_item["md5"] = md5
-                    tmp_path = filecache.get_tmpfile(get_ext(addr))
-                    data = file.file.read()
-                    logger.debug("## save to db " + tmp_path + " len " + str(len(data)))
-                    with open(tmp_path, "wb") as f:
-                        f.write(data)
-                    ret, ret_emb, detail = add_data(dic_item, tmp_path)
-                    if not ret_emb:
+                        addr = os.path.join(vault, addr)
+                    uploads.append((file, addr, md5))
+                is_async = request.POST.get("async", str(ingest.use_async())).lower() == "true"
+                if is_async:
+                    job = ingest.create_job(dic, uploads)
+                    return do_result(True, {"job": str(job.idx), "total": job.total})
+                results = ingest.map_items(lambda x: ingest.save_upload(dic, *x), uploads)
+                emb_status = "success"
+                for addr, result in zip(paths, results):
+                    if result["emb_status"] != "success":
                         emb_status = "failed"
-                    if ret:
+                    if result["status"] == ingest.ITEM_DONE:
                         success_list.append(addr)
                 if debug:
                     logger.info(f"upload_files success {success_list}")
                 if len(success_list) > 0:
-                    return do_result(True, {"list": success_list, "emb_status": emb_status})
+                    return do_result(
+                        True,
+                        {"list": success_list, "emb_status": emb_status, "results": results},
+                    )
                 else:
                     return do_result(False, _("no_update_needed"))
         except Exception as e:
@@ -151,6 +156,7 @@ class StoreEntryViewSet(viewsets.ModelViewSet):
         if status is not None and len(status) > 0:
             query_args["status"] = status
         keywords = request.GET.get("keyword", None)
+        search_mode = request.GET.get("search_mode", SEARCH_MODE_KEYWORD)
         start_date = request.GET.get("start_date", None)
         end_date = request.GET.get("end_date", None)
         if start_date is not None and len(start_date) > 0:
@@ -163,11 +169,11 @@ class StoreEntryViewSet(viewsets.ModelViewSet):
             )
 
         if debug:
-            logger.debug(f"args {query_args}, keyword {keywords}")
+            logger.debug(f"args {query_args}, keyword {keywords}, search_mode {search_mode}")
 
         if max_count != -1:
             count_limit = max_count
-        queryset = get_entry_list(keywords, query_args, count_limit)
+        queryset = get_entry_list(keywords, query_args, count_limit, search_mode=search_mode)
         logger.debug(f"list total: {len(queryset)}")
 
         if max_count == -1: # get item by page
@@ -202,6 +208,13 @@ class StoreEntryViewSet(viewsets.ModelViewSet):
             elif instance.etype == 'file' or instance.etype == 'note':
                 if instance.path.lower().endswith(('.png', '.jpg', '.jpeg', '.gif')):
                     user_id = instance.user_id
+                    if utils_filemanager.get_delivery_mode() == utils_filemanager.FILE_DELIVERY_REDIRECT:
+                        url = utils_filemanager.get_file_manager().get_url(user_id, instance.path)
+                        if url is not None:
+                            serializer = self.get_serializer(instance)
+                            data = serializer.data
+                            data['content'] = f"![]({url})"
+                            return Response(data)
                     rel_path = os.path.join(user_id, instance.path)
                     static_path = settings.STATICFILES_DIRS
                     if len(static_path) > 0:
@@ -222,20 +235,17 @@ class StoreEntryViewSet(viewsets.ModelViewSet):
                             return Response(data)
                     raise Http404
                 elif instance.path.lower().endswith('.md'): # markdown
-                    rel_path = instance.path
-                    user_id = instance.user_id
-                    file_path = filecache.get_tmpfile('.md')
-                    ret = utils_filemanager.get_file_manager().get_file(
-                        user_id, rel_path, file_path
+                    stream = utils_filemanager.get_file_manager().open_stream(
+                        instance.user_id, instance.path
                     )
-                    if ret:
-                        with open(file_path, 'r', encoding='utf-8') as file:
-                            content = file.read()
-                            serializer = self.get_serializer(instance)
-                            data = serializer.data
-                            data['content'] = content
-                            return Response(data)
-                    raise Http404
+                    try:
+                        content = stream.read().decode('utf-8')
+                    finally:
+                        stream.close()
+                    serializer = self.get_serializer(instance)
+                    data = serializer.data
+                    data['content'] = content
+                    return Response(data)
                 elif is_support(instance.path.lower()): # docx, pdf, txt, html
                     rel_path = instance.path
                     user_id = instance.user_id
@@ -297,42 +307,116 @@ class StoreEntryViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=["get"], url_path="download")
     def download(self, request, pk=None):
         """
-        Download file according to Django standard.
+        Stream the file from the store, supports Range requests
         """
         try:
             entry = self.get_object()
-            rel_path = entry.path
-            user_id = entry.user_id
-
-            ext = get_ext(rel_path)
-            file_path = filecache.get_tmpfile(ext)
-            ret = utils_filemanager.get_file_manager().get_file(
-                user_id, rel_path, file_path
-            )
-
-            if ret:
-                with open(file_path, "rb") as file:
-                    # Create an HttpResponse object
-                    ctype = get_content_type(file_path)
-                    logger.debug(f"download content type {ctype}")
-                    response = HttpResponse(FileWrapper(file), ctype)
-                    # Set the file name
-                    file_name = os.path.basename(rel_path)
-                    logger.debug(f"filename:{file_name}")
-                    file_name = smart_str(file_name)
-                    logger.debug(f"smart_str, filename:{file_name}")
-                    response["Content-Disposition"] = (
-                        f'attachment; filename="{file_name}"'
-                    )
-                    # Add the necessary CORS headers
-                    response["Access-Control-Allow-Origin"] = "*"
-                    response["Access-Control-Expose-Headers"] = "Content-Disposition"
+            if utils_filemanager.get_delivery_mode() == utils_filemanager.FILE_DELIVERY_REDIRECT:
+                response = get_redirect_response(entry.user_id, entry.path)
+                if response is not None:
                     return response
-            raise Http404
-        except:
+            return get_stream_response(request, entry.user_id, entry.path)
+        except Http404:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            logger.warning(f"download failed {e}")
             return Response(status=status.HTTP_404_NOT_FOUND)
 
 
+def get_redirect_response(user_id, rel_path):
+    """
+    Let the client or the web server send the file, None if the store can't
+    MinIO: 302 to a presigned url
+    Local: X-Accel-Redirect (nginx, FILE_ACCEL_PREFIX is the internal location of
+    LOCAL_FILE_STORE_DIR) or X-Sendfile (apache/lighttpd) when FILE_ACCEL_PREFIX is empty
+    """
+    manager = utils_filemanager.get_file_manager()
+    file_name = os.path.basename(rel_path)
+    url = manager.get_url(user_id, rel_path, download_name=file_name)
+    if url is not None:
+        return HttpResponseRedirect(url)
+    path = manager.get_local_path(user_id, rel_path)
+    if path is None:
+        return None
+    if not os.path.isfile(path):
+        raise Http404
+    response = HttpResponse(content_type=get_content_type(rel_path))
+    accel_prefix = os.environ.get("FILE_ACCEL_PREFIX", "")
+    if len(accel_prefix) > 0:
+        response["X-Accel-Redirect"] = quote(f"{accel_prefix.rstrip('/')}/{user_id}/{rel_path}")
+    else:
+        response["X-Sendfile"] = path
+    response["Content-Disposition"] = f"attachment; filename*=UTF-8''{quote(file_name)}"
+    response["Access-Control-Allow-Origin"] = "*"
+    response["Access-Control-Expose-Headers"] = "Content-Disposition"
+    return response
+
+
+def get_stream_response(request, user_id, rel_path):
+    """
+    StreamingHttpResponse of a stored file, 206 for a Range request
+    """
+    manager = utils_filemanager.get_file_manager()
+    size = manager.get_size(user_id, rel_path)
+    if size is None:
+        raise Http404
+    try:
+        byte_range = parse_range(request.headers.get("Range"), size)
+    except ValueError:
+        response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        response["Content-Range"] = f"bytes */{size}"
+        return response
+    if byte_range is None:
+        start, end = 0, size - 1
+    else:
+        start, end = byte_range
+    stream = manager.open_stream(user_id, rel_path, start, end - start + 1, size=size)
+    ctype = get_content_type(rel_path)
+    logger.debug(f"download content type {ctype}, range {byte_range}")
+    response = StreamingHttpResponse(
+        stream,
+        content_type=ctype,
+        status=status.HTTP_200_OK if byte_range is None else status.HTTP_206_PARTIAL_CONTENT,
+    )
+    response["Content-Length"] = str(end - start + 1)
+    response["Accept-Ranges"] = "bytes"
+    if byte_range is not None:
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+    # Set the file name
+    file_name = smart_str(os.path.basename(rel_path))
+    response["Content-Disposition"] = f'attachment; filename="{file_name}"'
+    # Add the necessary CORS headers
+    response["Access-Control-Allow-Origin"] = "*"
+    response["Access-Control-Expose-Headers"] = "Content-Disposition, Content-Range, Accept-Ranges"
+    return response
+
+
+class IngestJobViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Status and progress of queued uploads, see ingest.py
+    """
+
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [IsAuthenticated]
+    serializer_class = IngestJobSerializer
+
+    def get_queryset(self):
+        queryset = IngestJob.objects.filter(user_id=get_user_id(self.request))
+        status = self.request.GET.get("status", None)
+        if status is not None and len(status) > 0:
+            queryset = queryset.filter(status=status)
+        return queryset
+
+    @action(detail=True, methods=["post"], url_path="retry")
+    def retry(self, request, pk=None):
+        job = self.get_object()
+        if ingest.retry_job(job):
+            return do_result(True, {"job": str(job.idx)})
+        if job.status == IngestJob.Status.FAILED:
+            return do_result(False, _("job_files_removed"))
+        return do_result(False, _("job_status_colon_") + job.status)
+
+
 class EntryAPIView(APIView):
     authentication_classes = [TokenAuthentication]
     permission_classes = [IsAuthenticated]
@@ -16,7 +16,7 @@ from app_message.agent.base_agent import BaseAgent, agent_function
 from app_message.command import msg_common_select
 from app_record.record import get_export_file
 from app_message.function import search_data, regular_title
-from app_dataforge.entry import add_data
+from app_dataforge.entry import add_data, SEARCH_MODE_HYBRID
 from app_dataforge.misc_tools import add_url
 
 class RecordAgent(BaseAgent):
@@ -176,7 +176,7 @@ class DataAgent(BaseAgent):
             sdata.set_cache("prev_cmd", _("search_data"))
             return _("please_enter_search_content")
         else:
-            return search_data(sdata)
+            return search_data(sdata, search_mode=SEARCH_MODE_HYBRID)
 
     @agent_function(_("search_files"))
     def _afunc_file_search(context_variables: dict = None, content: str = None):
@@ -3,7 +3,7 @@ import pandas as pd
 from django.utils.translation import gettext as _
 from .command import *
 from backend.common.utils.regular_tools import regular_str
-from app_dataforge.entry import get_entry_list
+from app_dataforge.entry import get_entry_list, SEARCH_MODE_KEYWORD
 
 CMD_INNER_GET = "CMD_INNER_GET"
 
@@ -18,9 +18,9 @@ def regular_title(title):
     return title
 
     
-def search_data(sdata, dic={}):
+def search_data(sdata, dic={}, search_mode=SEARCH_MODE_KEYWORD):
     """
-    Search for data
+    Search for data, search_mode: keyword or vector
     """
     condition = {"user_id": sdata.user_id}
     condition.update(dic)
@@ -29,7 +29,7 @@ def search_data(sdata, dic={}):
     else:
         keyword = None
     logger.info(f"condition {condition}")
-    queryset = get_entry_list(keyword, condition, 5)
+    queryset = get_entry_list(keyword, condition, 5, search_mode=search_mode)
     df = pd.DataFrame(queryset.values())
     arr = []
     for idx, item in df.iterrows():
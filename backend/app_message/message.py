@@ -41,9 +41,14 @@ def msg_search_detail(dic):
             if sdata.source == "web":
                 return {"type": "text", "info": f"[{filename}]({WEB_URL}/view_markdown?idx={obj.idx})"}
             else:
+                manager = utils_filemanager.get_file_manager()
+                if utils_filemanager.get_delivery_mode() == utils_filemanager.FILE_DELIVERY_REDIRECT:
+                    url = manager.get_url(uid, obj.path, download_name=filename)
+                    if url is not None:
+                        return {"type": "file", "url": url, "filename": filename}
                 ext = get_ext(filename)
                 path = filecache.get_tmpfile(ext)
-                if utils_filemanager.get_file_manager().get_file(uid, obj.path, path):
+                if manager.get_file(uid, obj.path, path):
                     return {"type": "file", "path": path, "filename": filename}
         elif obj.etype == "web":
             if sdata.source == "web":
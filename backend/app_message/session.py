@@ -10,6 +10,7 @@ from backend.common.user.user import UserManager, DEFAULT_CHAT_LLM_SHOW_COUNT, D
 from backend.common.user.utils import parse_common_args
 from app_dataforge.entry import get_entry_list, add_data
 from app_dataforge.models import StoreEntry
+from app_dataforge.fts import get_search_vector
 from app_dataforge.feature import TITLE_MAX_LENGTH, DEFAULT_CATEGORY, EntryFeatureTool
 from backend.common.files.utils_file import count_tokens
 
@@ -153,7 +154,8 @@ class Session:
             ).update(title=dic["title"],
                      ctype=dic["ctype"],
                      raw=dic["raw"], 
-                     meta=dic["meta"])
+                     meta=dic["meta"],
+                     search_vector=get_search_vector(dic["title"], dic["raw"], dic["ctype"], self.sid))
             logger.info(f"update entry success")
         self.sync_idx = len(self.messages)
         logger.info(f"sync_idx {self.sync_idx}, len {len(self.messages)}")
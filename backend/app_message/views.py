@@ -117,10 +117,7 @@ def real_upload_file(request):
     logger.debug(f"real_upload_file {request.FILES}")
     for file in request.FILES.values():  # only support one file
         filename = file.name
-        tmp_path = filecache.get_tmpfile(get_ext(filename))
+        tmp_path = filecache.save_upload(file, get_ext(filename))
         logger.debug(f"file save to {tmp_path}")
-        with open(tmp_path, "wb") as f:
-            for chunk in file.chunks():
-                f.write(chunk)
         return True, tmp_path, filename
     return False, None, None
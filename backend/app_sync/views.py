@@ -22,6 +22,16 @@ from backend.common.utils.net_tools import do_result
 
 from app_dataforge.entry import delete_entry, regerate_embedding
 from app_dataforge.models import StoreEntry
+from app_dataforge import vector_index, backfill
+
+
+def get_vault_entries(uid, vault):
+    """
+    Notes of the user, of one vault if vault is given (ending with '/'), served by store_entry_sync
+    """
+    if vault is not None:
+        return StoreEntry.objects.filter(etype="note", addr__startswith=vault, user_id=uid)
+    return StoreEntry.objects.filter(etype="note", user_id=uid)
 
 
 class SyncAPIView(APIView):
@@ -49,6 +59,10 @@ class SyncAPIView(APIView):
             return self.do_check_embedding(args, request)
         elif rtype == "regerate_embedding":
             return self.do_regerate_embedding(args, request)
+        elif rtype == "backfill_embedding":  # regenerate all stale embeddings in the background
+            return self.do_backfill_embedding(args, request)
+        elif rtype == "backfill_status":
+            return self.do_backfill_status(args, request)
 
     def adjust_files(self, file_dic, include, exclude):
         """
@@ -86,6 +100,7 @@ class SyncAPIView(APIView):
         addrs = request.GET.get("addr_list", request.POST.get("addr_list", "[]"))
         use_embedding = EmbeddingTools.use_embedding()
         addrs = json.loads(addrs)
+        rebuild_index = request.GET.get("rebuild_index", request.POST.get("rebuild_index", "false"))
         logger.info(f"regerate embedding addrs {len(addrs)} {addrs[0]}...")
 
         # Update embedding of addrs in the database
@@ -98,6 +113,11 @@ class SyncAPIView(APIView):
                 emb_status = "failed"
                 logger.warning(f"regerate embedding failed {addr}")
                 break
+        if rebuild_index.lower() == "true":  # usually set by the client on the last batch
+            try:
+                vector_index.sync_indexes()
+            except Exception as e:
+                logger.warning(f"rebuild vector index failed {e}")
         return do_result(True, {"emb_status": emb_status})
 
     def do_check_embedding(self, args, request):
@@ -106,23 +126,29 @@ class SyncAPIView(APIView):
         """
         uid = args["user_id"]
         use_embedding = EmbeddingTools.use_embedding()
-        entries = (
-            StoreEntry.objects.filter(user_id=uid, is_deleted=False, raw__isnull=False)
-            .exclude(raw__exact="")
-            .values("addr", "emb_model")
-        )
-        entries = entries.distinct()
         addr_list = []
         model_name = EmbeddingTools.get_model_name(use_embedding)
         if model_name is not None:
-            for entry in entries:
-                if entry["emb_model"] == model_name:
-                    continue
-                addr_list.append(entry["addr"])
-        addr_list = list(set(addr_list))
+            addr_list = backfill.get_stale_addrs(uid, model_name)
         logger.info(f"check embedding return {len(addr_list)}")
         return do_result(True, {"list": addr_list})
 
+    def do_backfill_embedding(self, args, request):
+        """
+        Queue a backfill job, 'manage.py embedding_backfill' does the work
+        """
+        model_name = EmbeddingTools.get_model_name(EmbeddingTools.use_embedding())
+        if model_name is None:
+            return do_result(False, "no embedding model")
+        job = backfill.create_job(args["user_id"], model_name)
+        return do_result(True, backfill.get_job_info(job))
+
+    def do_backfill_status(self, args, request):
+        job = backfill.get_last_job(args["user_id"])
+        if job is None:
+            return do_result(False, "no backfill job")
+        return do_result(True, backfill.get_job_info(job))
+
     def check_update(self, args, request, debug=False):
         vault = request.GET.get("vault", request.POST.get("vault", None))
         last_sync_time = request.GET.get(
@@ -134,16 +160,9 @@ class SyncAPIView(APIView):
         )
 
         uid = args["user_id"]
-        if vault is not None:
-            if not vault.endswith("/"):
-                vault = vault + "/"
-            entries = StoreEntry.objects.filter(
-                block_id=0, etype="note", addr__startswith=vault, user_id=uid
-            ).aggregate(Max("updated_time"))
-        else:
-            entries = StoreEntry.objects.filter(
-                block_id=0, etype="note", user_id=uid
-            ).aggregate(Max("updated_time"))
+        if vault is not None and not vault.endswith("/"):
+            vault = vault + "/"
+        entries = get_vault_entries(uid, vault).aggregate(Max("updated_time"))
         max_updated_time = entries['updated_time__max']
         logger.info(f'check_update {last_sync_time} {max_updated_time}')
         if max_updated_time is None:
@@ -171,16 +190,11 @@ class SyncAPIView(APIView):
             last_sync_time / 1000, pytz.UTC
         )
         uid = args["user_id"]
-        if vault is not None:
-            if not vault.endswith("/"):
-                vault = vault + "/"
-            entries = StoreEntry.objects.filter(
-                block_id=0, etype="note", addr__startswith=vault, user_id=uid
-            ).values("idx", "updated_time", "md5", "is_deleted", "addr")
-        else:
-            entries = StoreEntry.objects.filter(
-                block_id=0, etype="note", user_id=uid
-            ).values("idx", "updated_time", "md5", "is_deleted", "addr")
+        if vault is not None and not vault.endswith("/"):
+            vault = vault + "/"
+        entries = get_vault_entries(uid, vault).values(
+            "idx", "updated_time", "md5", "is_deleted", "addr"
+        )
 
         cloud_dic = {}
         for entry in entries:
@@ -4,125 +4,327 @@ Manage local file cache
 
 import os
 import json
+import uuid
+import sqlite3
 import datetime
+import threading
+from contextlib import contextmanager
 from loguru import logger
 from django_cron import CronJobBase, Schedule
 from django.core.cache import cache
 
 DATA_DIR = "/tmp/"
 TMPFILE_DIR = "/tmp/files/"
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+CACHE_DAYS = 2  # cached files older than this are removed
+TMPFILE_CACHE_SIZE = 2048  # MB, env TMPFILE_CACHE_SIZE, 0 for no limit
+
+
+def get_cache_max_size():
+    return int(float(os.getenv("TMPFILE_CACHE_SIZE", TMPFILE_CACHE_SIZE)) * 1024 * 1024)
 
 
 def get_tmpfile_dir():
-    if not os.path.exists(TMPFILE_DIR):
-        os.makedirs(TMPFILE_DIR)
+    os.makedirs(TMPFILE_DIR, exist_ok=True)
     return TMPFILE_DIR
 
 
 def set_tmpfile_dir(dir):
     global TMPFILE_DIR
     TMPFILE_DIR = dir
-    if not os.path.exists(TMPFILE_DIR):
-        os.makedirs(TMPFILE_DIR)
+    os.makedirs(TMPFILE_DIR, exist_ok=True)
 
 
 def get_tmpfile(ext):
+    """
+    Unique path in the tmp dir, safe for parallel requests, threads and processes
+    The file is not created, converters skip outputs that already exist
+    """
     now = datetime.datetime.now()
     timestr = now.strftime("%Y%m%d_%H%M%S")
-    tmp_path = os.path.join(get_tmpfile_dir(), f"{timestr}{ext}")
-    file_dir = os.path.dirname(tmp_path)
-    if not os.path.exists(file_dir):
-        os.makedirs(file_dir)
-        logger.debug(f"create dir {file_dir}")
-    return tmp_path
+    return os.path.join(get_tmpfile_dir(), f"{timestr}_{uuid.uuid4().hex}{ext}")
+
+
+@contextmanager
+def tmpfile(ext):
+    """
+    with tmpfile(".md") as path: ..., the file is removed on exit
+    """
+    path = get_tmpfile(ext)
+    try:
+        yield path
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def write_upload(file, path):
+    """
+    Stream a django UploadedFile to path chunk by chunk, memory does not grow with the file size
+    """
+    size = 0
+    with open(path, "wb") as f:
+        for chunk in file.chunks(UPLOAD_CHUNK_SIZE):
+            f.write(chunk)
+            size += len(chunk)
+    return size
+
+
+def save_upload(file, ext):
+    """
+    Write an uploaded file to a new tmp file, return its path
+    """
+    path = get_tmpfile(ext)
+    write_upload(file, path)
+    return path
+
+
+@contextmanager
+def upload_tmpfile(file, ext):
+    """
+    with upload_tmpfile(request_file, ".pdf") as path: ..., the file is removed on exit
+    """
+    with tmpfile(ext) as path:
+        write_upload(file, path)
+        yield path
 
 
 class TmpFileManager:
+    """
+    Metadata of cached files, kept in sqlite (DATA_DIR/file_cache.db)
+    Every call is its own transaction, so web and worker processes can share it.
+    Info keys are indexed in file_key, get_file_by_key("url", url) is one lookup.
+    Files expire after CACHE_DAYS, and the least recently used ones are evicted
+    when the total size is over TMPFILE_CACHE_SIZE.
+    """
+
     # Single Example
     _instance = None
+    _lock = threading.Lock()
 
     @staticmethod
     def get_instance():
         if TmpFileManager._instance is None:
-            TmpFileManager._instance = TmpFileManager()
+            with TmpFileManager._lock:
+                if TmpFileManager._instance is None:
+                    TmpFileManager._instance = TmpFileManager()
         return TmpFileManager._instance
 
-    def __init__(self):
+    def __init__(self, data_dir=None):
+        if data_dir is None:
+            data_dir = DATA_DIR
         self.last_clear_time = None
-        self.file_cache = {}
-        self.file_cache_path = os.path.join(DATA_DIR, "file_cache.json")
+        self.local = threading.local()
+        self.db_path = os.path.join(data_dir, "file_cache.db")
+        self.file_cache_path = os.path.join(data_dir, "file_cache.json")  # before sqlite
+        with self.transaction() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS file (path TEXT PRIMARY KEY, info TEXT, time TEXT, "
+                "size INTEGER DEFAULT 0, atime REAL DEFAULT 0)"
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(file)")]
+            if "size" not in columns:
+                conn.execute("ALTER TABLE file ADD COLUMN size INTEGER DEFAULT 0")
+                conn.execute("ALTER TABLE file ADD COLUMN atime REAL DEFAULT 0")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS file_key (key TEXT, value TEXT, path TEXT, "
+                "PRIMARY KEY (key, value, path))"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS stat (name TEXT PRIMARY KEY, value INTEGER)")
+            conn.execute("CREATE INDEX IF NOT EXISTS file_key_path ON file_key (path)")
+            conn.execute("CREATE INDEX IF NOT EXISTS file_time ON file (time)")
+            conn.execute("CREATE INDEX IF NOT EXISTS file_atime ON file (atime)")
         self.load()
         self.clear()
 
     def __repr__(self) -> str:
-        return f"<TmpFileManager {len(self.file_cache)}>"
+        count = self.get_conn().execute("SELECT count(*) FROM file").fetchone()[0]
+        return f"<TmpFileManager {count}>"
+
+    def get_conn(self):
+        # sqlite connections can't be shared between threads
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self.get_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
 
     def load(self):
-        if os.path.exists(self.file_cache_path):
-            with open(self.file_cache_path, "r") as fp:
-                self.file_cache = json.load(fp)
+        """
+        Import file_cache.json written by older versions, once
+        """
+        if not os.path.exists(self.file_cache_path):
+            return
+        with open(self.file_cache_path, "r") as fp:
+            file_cache = json.load(fp)
+        with self.transaction() as conn:
+            for path, v in file_cache.items():
+                self.put_file(conn, path, v["info"], v["time"])
+        os.rename(self.file_cache_path, self.file_cache_path + ".bak")
+        logger.info(f"import {len(file_cache)} files from {self.file_cache_path}")
+
+    def put_file(self, conn, path, info, time):
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        conn.execute(
+            "INSERT OR REPLACE INTO file (path, info, time, size, atime) VALUES (?, ?, ?, ?, ?)",
+            (path, json.dumps(info), time, size, datetime.datetime.now().timestamp()),
+        )
+        self.put_keys(conn, path, info)
+
+    def put_keys(self, conn, path, info):
+        conn.execute("DELETE FROM file_key WHERE path = ?", (path,))
+        if info is not None:
+            conn.executemany(
+                "INSERT OR IGNORE INTO file_key (key, value, path) VALUES (?, ?, ?)",
+                [(key, json.dumps(value), path) for key, value in info.items()],
+            )
+
+    def remove_files(self, conn, paths):
+        conn.executemany("DELETE FROM file_key WHERE path = ?", [(path,) for path in paths])
+        conn.executemany("DELETE FROM file WHERE path = ?", [(path,) for path in paths])
 
-    def save(self, with_clear=True):
-        with open(self.file_cache_path, "w") as fp:
-            json.dump(self.file_cache, fp)
-        if with_clear:
-            self.clear()
+    def count(self, conn, name, value=1):
+        conn.execute(
+            "INSERT INTO stat (name, value) VALUES (?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+            (name, value),
+        )
 
     def add_file(self, path, info={}):
         now = datetime.datetime.now()
-        self.file_cache[path] = {
-            "info": info,
-            "time": now.strftime("%Y-%m-%d %H:%M:%S"),
-        }
-        self.save()
+        with self.transaction() as conn:
+            self.put_file(conn, path, info, now.strftime("%Y-%m-%d %H:%M:%S"))
+        self.evict(keep=path)
+        self.clear()
 
     def get_file_info(self, path):
-        if path in self.file_cache:
-            return self.file_cache[path]["info"]
+        row = self.get_conn().execute("SELECT info FROM file WHERE path = ?", (path,)).fetchone()
+        if row is not None:
+            return json.loads(row[0])
         return None
 
     def set_file_info(self, path, key, value):
-        if path in self.file_cache:
-            if self.file_cache[path]["info"] is None:
-                self.file_cache[path]["info"] = {}
-            self.file_cache[path]["info"][key] = value
-            self.save()
+        with self.transaction() as conn:
+            row = conn.execute("SELECT info FROM file WHERE path = ?", (path,)).fetchone()
+            if row is not None:
+                info = json.loads(row[0])
+                if info is None:
+                    info = {}
+                info[key] = value
+                conn.execute("UPDATE file SET info = ? WHERE path = ?", (json.dumps(info), path))
+                self.put_keys(conn, path, info)
 
     def get_file_by_key(self, key, value):
-        for path, v in self.file_cache.items():
-            if v["info"] is not None and key in v["info"] and v["info"][key] == value:
+        """
+        Cached file with info[key] == value, a hit marks it as recently used
+        """
+        with self.transaction() as conn:
+            rows = conn.execute(
+                "SELECT path FROM file_key WHERE key = ? AND value = ?", (key, json.dumps(value))
+            ).fetchall()
+            found = None
+            lost = []
+            for (path,) in rows:
                 if os.path.exists(path):
-                    return path
-        return None
+                    found = path
+                    break
+                lost.append(path)
+            self.remove_files(conn, lost)
+            if found is not None:
+                conn.execute(
+                    "UPDATE file SET atime = ? WHERE path = ?",
+                    (datetime.datetime.now().timestamp(), found),
+                )
+                self.count(conn, "hits")
+            else:
+                self.count(conn, "misses")
+        return found
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used files until the cache fits in TMPFILE_CACHE_SIZE
+        """
+        max_size = get_cache_max_size()
+        if max_size <= 0:
+            return []
+        with self.transaction() as conn:
+            total = conn.execute("SELECT coalesce(sum(size), 0) FROM file").fetchone()[0]
+            if total <= max_size:
+                return []
+            paths = []
+            for path, size in conn.execute("SELECT path, size FROM file ORDER BY atime"):
+                if total <= max_size:
+                    break
+                if path == keep:
+                    continue
+                paths.append(path)
+                total -= size
+            self.remove_files(conn, paths)
+            self.count(conn, "evictions", len(paths))
+        for path in paths:
+            logger.debug(f"evict cache file {path}")
+            if os.path.exists(path):
+                os.remove(path)
+        return paths
 
-    def clear(self):
+    def get_stats(self):
+        """
+        Counters for monitoring, see 'manage.py file_cache'
+        """
+        conn = self.get_conn()
+        count, size = conn.execute("SELECT count(*), coalesce(sum(size), 0) FROM file").fetchone()
+        stats = {"count": count, "size": size, "max_size": get_cache_max_size()}
+        for name in ["hits", "misses", "evictions"]:
+            row = conn.execute("SELECT value FROM stat WHERE name = ?", (name,)).fetchone()
+            stats[name] = row[0] if row is not None else 0
+        return stats
+
+    def clear(self, force=False):
         if (
-            self.last_clear_time is None
+            force
+            or self.last_clear_time is None
             or (datetime.datetime.now() - self.last_clear_time).days > 1
         ):
             self.last_clear_time = datetime.datetime.now()
             logger.info("now clear file cache")
             # Convenient file caching, deletes expired files, whether they are in the cache directory or not
-            now = datetime.datetime.now()
-            for path in list(self.file_cache.keys()):
-                if (
-                    now
-                    - datetime.datetime.strptime(
-                        self.file_cache[path]["time"], "%Y-%m-%d %H:%M:%S"
-                    )
-                ).days > 1:
-                    logger.debug(f"remove cache file {path}")
-                    del self.file_cache[path]
-                    if os.path.exists(path):
-                        os.remove(path)
-            self.save(False)
-            # Deleting Files Not in the Cache List
+            expire_time = datetime.datetime.now() - datetime.timedelta(days=CACHE_DAYS)
+            expire_str = expire_time.strftime("%Y-%m-%d %H:%M:%S")
+            with self.transaction() as conn:
+                rows = conn.execute("SELECT path FROM file WHERE time < ?", (expire_str,))
+                paths = [path for (path,) in rows.fetchall()]
+                self.remove_files(conn, paths)
+            for path in paths:
+                logger.debug(f"remove cache file {path}")
+                if os.path.exists(path):
+                    os.remove(path)
+            # Deleting old files not in the cache list, newer ones may be in use by another process
+            conn = self.get_conn()
             for root, dirs, files in os.walk(get_tmpfile_dir()):
                 for file in files:
                     path = os.path.join(root, file)
-                    if path not in self.file_cache:
-                        logger.debug(f"remove loss file {path}")
-                        os.remove(path)
+                    try:
+                        if os.path.getmtime(path) > expire_time.timestamp():
+                            continue
+                        row = conn.execute("SELECT 1 FROM file WHERE path = ?", (path,)).fetchone()
+                        if row is None:
+                            logger.debug(f"remove loss file {path}")
+                            os.remove(path)
+                    except FileNotFoundError:
+                        pass
+            self.evict()
 
 
 def init(dir):
@@ -2,25 +2,128 @@
 Provide file management functionality, support file address saving, use cloud storage
 """
 
+import io
 import os
+import fcntl
 import minio
+import minio.error
+import uuid
 import shutil
+import hashlib
+import urllib3
+import datetime
+import threading
 import traceback
+import contextlib
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
 from loguru import logger
 from minio.commonconfig import CopySource
 
 
+STREAM_CHUNK_SIZE = 64 * 1024
+FILE_DELIVERY_STREAM = "stream"  # bytes go through the django process
+FILE_DELIVERY_REDIRECT = "redirect"  # presigned url (minio), X-Accel-Redirect/X-Sendfile (local)
+FILE_URL_EXPIRES = 600  # seconds, env FILE_URL_EXPIRES
+
+
+UPLOAD_THREADS = 4  # background save_file_async uploads, env UPLOAD_THREADS
+_upload_executor = None
+_upload_executor_lock = threading.Lock()
+
+
+def get_upload_executor():
+    global _upload_executor
+    if _upload_executor is None:
+        with _upload_executor_lock:
+            if _upload_executor is None:
+                _upload_executor = ThreadPoolExecutor(
+                    max_workers=max(1, int(os.environ.get("UPLOAD_THREADS", UPLOAD_THREADS))),
+                    thread_name_prefix="file_upload",
+                )
+    return _upload_executor
+
+
+def get_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def get_delivery_mode():
+    return os.environ.get("FILE_DELIVERY", FILE_DELIVERY_STREAM)
+
+
+def get_url_expires():
+    return int(os.environ.get("FILE_URL_EXPIRES", FILE_URL_EXPIRES))
+
+
+class FileStream:
+    """
+    Readable byte range of a stored file, returned by FileManager.open_stream
+    Iterate it for chunks (e.g. StreamingHttpResponse), close() releases the file or connection
+    """
+
+    def __init__(self, reader, size, start, length, release=None):
+        self.reader = reader
+        self.size = size  # of the whole file
+        self.start = start
+        self.length = length
+        self.remaining = length
+        self.release = release
+
+    def read(self, n=-1):
+        if self.remaining <= 0:
+            return b""
+        if n is None or n < 0 or n > self.remaining:
+            n = self.remaining
+        data = self.reader.read(n)
+        self.remaining -= len(data)
+        return data
+
+    def __iter__(self):
+        while True:
+            data = self.read(STREAM_CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        self.reader.close()
+        if self.release is not None:
+            self.release()
+
+
 class FileManager:
-    def save_file(self, uid, filename, path):
+    def save_file(self, uid, filename, path, md5=None, resume=False):
         """
         Save File
         Args:
             uid: User ID
             filename: Name of the file to be saved
             path: Actual path of the file
+            md5: md5 of the file if the caller has it
+            resume: an earlier attempt may have saved the file already
         """
         raise NotImplementedError
 
+    def save_file_async(self, uid, filename, path, md5=None, resume=False):
+        """
+        Start save_file in a background thread and return a Future of its result,
+        the caller can parse the local file meanwhile and wait before committing
+        """
+        return get_upload_executor().submit(self.save_file, uid, filename, path, md5, resume)
+
     def get_file(self, uid, filename, path):
         """
         Get File
@@ -38,9 +141,44 @@ class FileManager:
         """
         raise NotImplementedError
 
+    def get_size(self, uid, filename):
+        """
+        Size of the file in bytes, None if it doesn't exist
+        """
+        raise NotImplementedError
+
+    def get_url(self, uid, filename, download_name=None):
+        """
+        Short-lived url the client can fetch the file from directly, None if the store has none
+        Args:
+            download_name: file name for Content-Disposition: attachment, None to show inline
+        """
+        return None
+
+    def get_local_path(self, uid, filename):
+        """
+        Path of the file on the local disk, for X-Accel-Redirect/X-Sendfile, None if not local
+        """
+        return None
+
+    def open_stream(self, uid, filename, start=0, length=None, size=None):
+        """
+        Open the file for reading without copying it to a local file
+        Args:
+            start: first byte
+            length: bytes to read, None to the end of the file
+            size: size of the file if the caller has it from get_size, saves a request
+        Return FileStream
+        """
+        raise NotImplementedError
+
 
-class MinioFileManager:
+class MinioFileManager(FileManager):
     BUCKET_NAME = "dataforge"
+    POOL_SIZE = 32  # connections kept to the server, env MINIO_POOL_SIZE
+    PART_SIZE = 16  # MB, multipart upload part size (min 5), env MINIO_PART_SIZE
+    PARALLEL_UPLOADS = 4  # parts uploaded at the same time, env MINIO_PARALLEL_UPLOADS
+    TIMEOUT = 30  # seconds, connect and read
 
     def __init__(self, minio_host=None, minio_access_key=None, minio_secret_key=None):
         if minio_host is None:
@@ -49,19 +187,80 @@ class MinioFileManager:
             minio_access_key = os.environ.get("MINIO_ACCESS_KEY")
         if minio_secret_key is None:
             minio_secret_key = os.environ.get("MINIO_SECRET_KEY")
-        logger.info(
-            f"minio_host {minio_host}, minio_access_key {minio_access_key}, minio_secret_key {minio_secret_key}"
+        logger.info(f"minio_host {minio_host}, minio_access_key {minio_access_key}")
+        # one pool for all requests of the process, instead of a new client per call
+        http_client = urllib3.PoolManager(
+            maxsize=int(os.environ.get("MINIO_POOL_SIZE", MinioFileManager.POOL_SIZE)),
+            block=False,
+            timeout=urllib3.Timeout(
+                connect=MinioFileManager.TIMEOUT, read=MinioFileManager.TIMEOUT
+            ),
+            retries=urllib3.Retry(
+                total=5,
+                backoff_factor=0.5,
+                status_forcelist=[500, 502, 503, 504],
+            ),
         )
         self.client = minio.Minio(
-            minio_host, minio_access_key, minio_secret_key, secure=False
+            minio_host,
+            minio_access_key,
+            minio_secret_key,
+            secure=False,
+            region=os.environ.get("MINIO_REGION") or None,  # set to skip the bucket location lookup
+            http_client=http_client,
         )
+        self.bucket_ready = False
+        self.bucket_lock = threading.Lock()
+
+    def ensure_bucket(self):
+        """
+        Check/create the bucket once per process, not before every upload
+        """
+        if self.bucket_ready:
+            return
+        with self.bucket_lock:
+            if not self.bucket_ready:
+                if not self.client.bucket_exists(MinioFileManager.BUCKET_NAME):
+                    self.client.make_bucket(MinioFileManager.BUCKET_NAME)
+                self.bucket_ready = True
+
+    @staticmethod
+    def get_part_size():
+        size = int(os.environ.get("MINIO_PART_SIZE", MinioFileManager.PART_SIZE))
+        return max(5, size) * 1024 * 1024  # S3 rejects parts smaller than 5MB
 
-    def save_file(self, uid, filename, path):
+    def is_uploaded(self, remote_path, size, md5):
+        """
+        The object is already there with the same content, e.g. a retried upload
+        """
+        try:
+            stat = self.client.stat_object(MinioFileManager.BUCKET_NAME, remote_path)
+        except minio.error.S3Error:
+            return False
+        return stat.size == size and stat.metadata.get("x-amz-meta-md5") == md5
+
+    def save_file(self, uid, filename, path, md5=None, resume=False):
         try:
-            if not self.client.bucket_exists(MinioFileManager.BUCKET_NAME):
-                self.client.make_bucket(MinioFileManager.BUCKET_NAME)
+            self.ensure_bucket()
             remote_path = f"{uid}/{filename}"
-            self.client.fput_object(MinioFileManager.BUCKET_NAME, remote_path, path)
+            # only a retried upload pays for the HEAD request (and reading the file without md5)
+            if resume:
+                if md5 is None:
+                    md5 = get_md5(path)
+                if self.is_uploaded(remote_path, os.path.getsize(path), md5):
+                    logger.debug(f"save_file skip uploaded {remote_path}")
+                    return True
+            # files larger than one part are sent as multipart upload, parts in parallel
+            self.client.fput_object(
+                MinioFileManager.BUCKET_NAME,
+                remote_path,
+                path,
+                metadata={"md5": md5} if md5 is not None else None,
+                part_size=self.get_part_size(),
+                num_parallel_uploads=int(
+                    os.environ.get("MINIO_PARALLEL_UPLOADS", MinioFileManager.PARALLEL_UPLOADS)
+                ),
+            )
             return True
         except Exception as e:
             logger.warning(f"save_file failed {e}")
@@ -76,6 +275,44 @@ class MinioFileManager:
             logger.warning(f"get_file failed {e}, filename {filename}, path {path}")
             return False
 
+    def get_size(self, uid, filename):
+        try:
+            remote_path = f"{uid}/{filename}"
+            return self.client.stat_object(MinioFileManager.BUCKET_NAME, remote_path).size
+        except minio.error.S3Error as e:
+            logger.warning(f"get_size failed {e}, filename {filename}")
+            return None
+
+    def get_url(self, uid, filename, download_name=None):
+        try:
+            response_headers = None
+            if download_name is not None:
+                response_headers = {
+                    "response-content-disposition": f"attachment; filename*=UTF-8''{quote(download_name)}"
+                }
+            return self.client.presigned_get_object(
+                MinioFileManager.BUCKET_NAME,
+                f"{uid}/{filename}",
+                expires=datetime.timedelta(seconds=get_url_expires()),
+                response_headers=response_headers,
+            )
+        except Exception as e:
+            logger.warning(f"get_url failed {e}, filename {filename}")
+            return None
+
+    def open_stream(self, uid, filename, start=0, length=None, size=None):
+        remote_path = f"{uid}/{filename}"
+        if size is None:
+            size = self.client.stat_object(MinioFileManager.BUCKET_NAME, remote_path).size
+        if length is None:
+            length = size - start
+        if length <= 0:
+            return FileStream(io.BytesIO(), size, start, 0)
+        response = self.client.get_object(
+            MinioFileManager.BUCKET_NAME, remote_path, offset=start, length=length
+        )
+        return FileStream(response, size, start, length, release=response.release_conn)
+
     def delete_file(self, uid, filename):
         try:
             remote_path = f"{uid}/{filename}"
@@ -100,18 +337,93 @@ class MinioFileManager:
             return False
 
 
-class LocalFileManager:
-    def __init__(self, base_path):
+class LocalFileManager(FileManager):
+    """
+    Files are kept under base_path/uid/filename. With dedup on, every file is a hard
+    link to a content-addressed blob base_path/.blobs/<sha256[:2]>/<sha256>, identical
+    files share one copy on disk and the link count of a blob is its reference count
+    """
+
+    BLOB_DIR = ".blobs"
+    BLOB_LOCK = ".lock"
+
+    def __init__(self, base_path, dedup=False):
         self.base_path = base_path
+        self.dedup = dedup
+
+    def get_blob_path(self, digest):
+        return os.path.join(self.base_path, LocalFileManager.BLOB_DIR, digest[:2], digest)
 
-    def save_file(self, uid, filename, path):
+    @contextlib.contextmanager
+    def lock_blobs(self):
+        """
+        Hold while links to blobs are added or removed, the web server and the workers
+        are different processes, so it's a file lock and not a threading.Lock
+        """
+        lock_path = os.path.join(self.base_path, LocalFileManager.BLOB_DIR, LocalFileManager.BLOB_LOCK)
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+        with open(lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def put_blob(self, path, digest=None):
+        """
+        Copy the file into the blob store if its content is not there yet, return the blob path
+        """
+        if digest is None:
+            digest = get_sha256(path)
+        blob_path = self.get_blob_path(digest)
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            tmp_path = f"{blob_path}.{uuid.uuid4().hex}.tmp"
+            shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, blob_path)
+        return blob_path
+
+    def find_blob(self, path):
+        """
+        Blob of a stored file, None if the file is not linked to the blob store
+        """
+        if not os.path.isfile(path) or os.stat(path).st_nlink < 2:
+            return None
+        blob_path = self.get_blob_path(get_sha256(path))
+        if os.path.exists(blob_path) and os.path.samefile(path, blob_path):
+            return blob_path
+        return None
+
+    def release_blob(self, blob_path):
+        """
+        Remove the blob when no stored file links to it any more
+        """
+        if blob_path is not None and os.path.exists(blob_path) and os.stat(blob_path).st_nlink == 1:
+            os.remove(blob_path)
+            logger.debug(f"release blob {blob_path}")
+
+    def link_file(self, path, path_dst):
+        digest = get_sha256(path)  # outside the lock, it reads the whole file
+        with self.lock_blobs():
+            blob_path = self.put_blob(path, digest)
+            if os.path.exists(path_dst) and os.path.samefile(blob_path, path_dst):
+                return  # same content, nothing to write
+            old_blob = self.find_blob(path_dst)
+            tmp_path = f"{path_dst}.{uuid.uuid4().hex}.tmp"
+            os.link(blob_path, tmp_path)
+            os.replace(tmp_path, path_dst)
+            self.release_blob(old_blob)
+
+    def save_file(self, uid, filename, path, md5=None, resume=False):
         try:
             path_dst = os.path.join(self.base_path, uid, filename)
             file_dir = os.path.dirname(path_dst)
             if not os.path.exists(file_dir):
                 os.makedirs(file_dir)
                 logger.debug(f"create dir {file_dir}")
-            if not os.path.exists(path_dst) or not os.path.samefile(path, path_dst):
+            if self.dedup:
+                self.link_file(path, path_dst)
+            elif not os.path.exists(path_dst) or not os.path.samefile(path, path_dst):
                 shutil.copyfile(path, path_dst)
             return True
         except Exception as e:
@@ -120,6 +432,27 @@ class LocalFileManager:
             logger.warning(f"save_file failed {e}")
             return False
 
+    def dedup_files(self):
+        """
+        Move files saved before dedup was turned on into the blob store, return (files, bytes saved)
+        """
+        count = 0
+        saved = 0
+        for root, dirs, files in os.walk(self.base_path):
+            if root == self.base_path and LocalFileManager.BLOB_DIR in dirs:
+                dirs.remove(LocalFileManager.BLOB_DIR)
+            for name in files:
+                path = os.path.join(root, name)
+                if os.path.islink(path) or os.stat(path).st_nlink > 1:
+                    continue
+                existed = os.path.exists(self.get_blob_path(get_sha256(path)))
+                self.link_file(path, path)
+                if existed:
+                    saved += os.path.getsize(path)
+                count += 1
+        logger.info(f"dedup_files {self.base_path}, {count} files, {saved} bytes saved")
+        return count, saved
+
     def get_file(self, uid, filename, path):
         try:
             shutil.copyfile(f"{self.base_path}/{uid}/{filename}", path)
@@ -128,11 +461,34 @@ class LocalFileManager:
             logger.warning(f"get_file failed {e}")
             return False
 
+    def get_size(self, uid, filename):
+        path = f"{self.base_path}/{uid}/{filename}"
+        if not os.path.isfile(path):
+            return None
+        return os.path.getsize(path)
+
+    def get_local_path(self, uid, filename):
+        return os.path.join(self.base_path, uid, filename)
+
+    def open_stream(self, uid, filename, start=0, length=None, size=None):
+        fp = open(f"{self.base_path}/{uid}/{filename}", "rb")
+        size = os.fstat(fp.fileno()).st_size
+        if length is None:
+            length = size - start
+        fp.seek(start)
+        return FileStream(fp, size, start, max(length, 0))
+
     def delete_file(self, uid, filename):
         try:
             path = f"{self.base_path}/{uid}/{filename}"
             if os.path.exists(path):
-                os.remove(path)
+                if self.dedup:
+                    with self.lock_blobs():
+                        blob_path = self.find_blob(path)
+                        os.remove(path)
+                        self.release_blob(blob_path)
+                else:
+                    os.remove(path)
             else:
                 logger.warning(f"delete_file failed {path} not exists")
             return True
@@ -145,21 +501,43 @@ class LocalFileManager:
         real_newpath = f"{self.base_path}/{uid}/{newpath}"
         try:
             # logger.debug(f'rename_file {real_oldpath} to {real_newpath}')
-            os.rename(real_oldpath, real_newpath)
+            if self.dedup:
+                with self.lock_blobs():
+                    old_blob = self.find_blob(real_newpath)
+                    os.rename(real_oldpath, real_newpath)
+                    self.release_blob(old_blob)
+            else:
+                os.rename(real_oldpath, real_newpath)
             return True
         except Exception as e:
             logger.warning(f"rename_file failed {e}")
             return False
 
 
+_managers = {}
+_managers_lock = threading.Lock()
+
+
 def get_file_manager():
     """
-    Get File Manager
+    Get File Manager, one instance per store setting, shared by all threads
     """
     if os.environ.get("FILE_STORE") == "local":
-        return LocalFileManager(os.environ.get("LOCAL_FILE_STORE_DIR"))
+        dedup = os.environ.get("LOCAL_FILE_DEDUP", "False").lower() == "true"
+        key = ("local", os.environ.get("LOCAL_FILE_STORE_DIR"), dedup)
     else:
-        return MinioFileManager()
+        key = ("minio", os.environ.get("MINIO_HOST"), os.environ.get("MINIO_ACCESS_KEY"))
+    manager = _managers.get(key)
+    if manager is None:
+        with _managers_lock:
+            manager = _managers.get(key)
+            if manager is None:
+                if key[0] == "local":
+                    manager = LocalFileManager(key[1], dedup=key[2])
+                else:
+                    manager = MinioFileManager()
+                _managers[key] = manager
+    return manager
 
 
 def test():
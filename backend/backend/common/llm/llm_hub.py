@@ -1,7 +1,9 @@
 import os
 import re
 import time
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from loguru import logger
 
 from langchain.text_splitter import RecursiveCharacterTextSplitter
@@ -10,11 +12,17 @@ from langchain_community.embeddings import OllamaEmbeddings
 from django.utils.translation import gettext as _
 
 from backend.common.llm import llm_tools
+from backend.common.llm.local_embedding import LocalEmbeddings, get_local_threads, EMBEDDING_LOCAL_MODEL
 from backend.common.user.user import *
 from backend.common.user.resource import *
 from backend.common.utils import text_tools 
 
 EMBEDDING_CHUNK_SIZE = 512
+# per backend: texts per request, requests in flight in this process, env EMBEDDING_BATCH_SIZE/EMBEDDING_CONCURRENCY
+EMBEDDING_BATCH_SIZE = {"openai": 256, "ollama": 16, "local": 32}
+EMBEDDING_CONCURRENCY = {"openai": 4, "ollama": 2, "local": 2}
+EMBEDDING_RETRIES = 3  # env EMBEDDING_RETRIES
+EMBEDDING_RETRY_DELAY = 1  # seconds, doubled on every retry
 
 def llm_query(uid, role, question, app, engine_type=None, debug=False):
     start_time = time.time()
@@ -92,8 +100,8 @@ class EmbeddingTools:
 
     def __init__(self):
         self.model = None
-        self.model_name = None
-        self.model_ollama_url = None
+        self.model_key = None
+        self.model_lock = threading.Lock()
 
     @staticmethod
     def get_model_name(use_embedding=True):
@@ -106,45 +114,50 @@ class EmbeddingTools:
             return None
         if embedding_type == "openai":
             return embedding_type
+        if embedding_type == "local":
+            return os.getenv("EMBEDDING_LOCAL_MODEL", EMBEDDING_LOCAL_MODEL)
         if ollama_model == "none" or ollama_model is None:
             return None
         return ollama_model
 
     def get_model(self):
         """
-        Get model instance
+        Get model instance, loaded again only when the setting changes
         args:
-            model_name: None, openai, ollama
+            model_name: None, openai, ollama, local
         """
         embedding_type, ollama_url, ollama_model = (
             EmbeddingTools.load_embedding_setting()
         )
         model_name = EmbeddingTools.get_model_name()
-        if self.model_name is None and model_name is None:
-            return self.model
-        if self.model_name == model_name:
-            if model_name == "openai":
-                return self.model
-            if model_name == "ollama" and self.model_ollama_url == ollama_url:
+        key = (embedding_type, model_name, ollama_url)
+        with self.model_lock:
+            if self.model_key == key:
                 return self.model
 
-        logger.info(f"now loading model {model_name}")
-        if embedding_type == "openai":
-            self.model = OpenAIEmbeddings()
-        elif embedding_type == "ollama":
-            if (
-                ollama_url is None
-                or ollama_url == "none"
-                or ollama_model is None
-                or ollama_model == "none"
-            ):
-                return None
-            self.model = OllamaEmbeddings(base_url=ollama_url, model=ollama_model)
-        else:  # None
-            self.model = None
-        self.model_name = model_name
-        self.model_ollama_url = ollama_url
-        return self.model
+            logger.info(f"now loading model {model_name}")
+            if embedding_type == "openai":
+                self.model = OpenAIEmbeddings()
+            elif embedding_type == "ollama":
+                if (
+                    ollama_url is None
+                    or ollama_url == "none"
+                    or ollama_model is None
+                    or ollama_model == "none"
+                ):
+                    return None
+                self.model = OllamaEmbeddings(base_url=ollama_url, model=ollama_model)
+            elif embedding_type == "local":
+                concurrency = EmbeddingTools.get_batch_setting(embedding_type)[1]
+                self.model = LocalEmbeddings(
+                    model_name,
+                    cache_dir=os.getenv("EMBEDDING_LOCAL_CACHE_DIR") or None,
+                    threads=get_local_threads(concurrency),
+                )
+            else:  # None
+                self.model = None
+            self.model_key = key
+            return self.model
 
     @staticmethod
     def split(raw, chunk_size=EMBEDDING_CHUNK_SIZE, chunk_overlap=50):
@@ -167,25 +180,112 @@ class EmbeddingTools:
         ollama_model = os.getenv("EMBEDDING_OLLAMA_MODEL", None)
         return embedding_type, ollama_url, ollama_model
 
+    @staticmethod
+    def get_batch_setting(embedding_type):
+        batch_size = os.getenv("EMBEDDING_BATCH_SIZE")
+        if not batch_size:
+            batch_size = EMBEDDING_BATCH_SIZE.get(embedding_type, 16)
+        concurrency = os.getenv("EMBEDDING_CONCURRENCY")
+        if not concurrency:
+            concurrency = EMBEDDING_CONCURRENCY.get(embedding_type, 1)
+        return max(1, int(batch_size)), max(1, int(concurrency))
+
+    _limits = {}
+    _limits_lock = threading.Lock()
+
+    @staticmethod
+    def get_limit(embedding_type, concurrency):
+        """
+        Semaphore shared by all threads, caps the requests in flight to one backend
+        """
+        key = (embedding_type, concurrency)
+        with EmbeddingTools._limits_lock:
+            if key not in EmbeddingTools._limits:
+                EmbeddingTools._limits[key] = threading.BoundedSemaphore(concurrency)
+            return EmbeddingTools._limits[key]
+
+    @staticmethod
+    def embed_batch(model, texts, limit, debug=False):
+        """
+        Embed one batch, retried with backoff, None if it still fails
+        """
+        retries = int(os.getenv("EMBEDDING_RETRIES", EMBEDDING_RETRIES))
+        delay = EMBEDDING_RETRY_DELAY
+        for attempt in range(retries + 1):
+            try:
+                with limit:
+                    result = model.embed_documents(texts)
+                if len(result) != len(texts):
+                    raise ValueError(f"got {len(result)} vectors")
+                return result
+            except Exception as e:
+                logger.warning(f"embedding batch of {len(texts)} failed ({attempt + 1}) {e}")
+                if attempt < retries:
+                    time.sleep(delay)
+                    delay *= 2
+        return None
+
     @staticmethod
     def do_embedding(all_splits, use_embedding, debug=False):
-        ret = False
-        embeddings = []
+        """
+        Embed the texts in batches, several batches in flight at the same time
+        ret is True only if every text got a vector, texts of failed batches get None
+        """
         if debug:
             logger.info(f"embedding {use_embedding}")
+        embeddings = [None for split in all_splits]
+        if not use_embedding:
+            return False, embeddings
+        if len(all_splits) == 0:
+            return True, embeddings
         try:
-            if not use_embedding:
-                embeddings = [None for split in all_splits]
-            else:
-                model = EmbeddingTools.get_instance().get_model()
-                if debug:
-                    logger.info(f"embedding model {model}")
-                if model is not None:
-                    embeddings = model.embed_documents(all_splits)
-                    ret = True
-                else:
-                    embeddings = [None for split in all_splits]
+            model = EmbeddingTools.get_instance().get_model()
         except Exception as e:
             logger.warning(f"failed {e}")
-            embeddings = [None for split in all_splits]
-        return ret, embeddings
+            return False, embeddings
+        if debug:
+            logger.info(f"embedding model {model}")
+        if model is None:
+            return False, embeddings
+
+        embedding_type = EmbeddingTools.load_embedding_setting()[0]
+        batch_size, concurrency = EmbeddingTools.get_batch_setting(embedding_type)
+        limit = EmbeddingTools.get_limit(embedding_type, concurrency)
+        starts = list(range(0, len(all_splits), batch_size))
+
+        def run(start):
+            return EmbeddingTools.embed_batch(
+                model, all_splits[start : start + batch_size], limit, debug=debug
+            )
+
+        if len(starts) == 1:
+            results = [run(starts[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=min(concurrency, len(starts))) as executor:
+                results = list(executor.map(run, starts))
+        failed = 0
+        for start, result in zip(starts, results):
+            if result is None:
+                failed += 1
+                continue
+            embeddings[start : start + len(result)] = result
+        if failed > 0:
+            logger.warning(f"embedding {failed}/{len(starts)} batches failed")
+        return failed == 0, embeddings
+
+    @staticmethod
+    def do_query_embedding(text, use_embedding, debug=False):
+        """
+        Embed a search query with the current embedding model
+        """
+        if not use_embedding or text is None or len(text) == 0:
+            return False, None
+        try:
+            model = EmbeddingTools.get_instance().get_model()
+            if debug:
+                logger.info(f"query embedding model {model}")
+            if model is not None:
+                return True, model.embed_query(text)
+        except Exception as e:
+            logger.warning(f"query embedding failed {e}")
+        return False, None
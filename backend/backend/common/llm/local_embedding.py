@@ -0,0 +1,45 @@
+"""
+In-process embedding on CPU, EMBEDDING_TYPE=local
+
+Runs a small sentence-embedding model with fastembed (ONNX Runtime), no embedding
+service and no network hop per request, the model files are downloaded once to
+EMBEDDING_LOCAL_CACHE_DIR (copy them there for air-gapped installs).
+fastembed is optional: pip install fastembed
+"""
+
+import os
+from loguru import logger
+
+EMBEDDING_LOCAL_MODEL = "BAAI/bge-small-zh-v1.5"
+EMBEDDING_LOCAL_BATCH_SIZE = 32  # texts per inference run
+
+
+class LocalEmbeddings:
+    """
+    Same interface as the langchain embeddings, embed_documents/embed_query
+    One ONNX session is shared, it can run several batches from different threads at once
+    """
+
+    def __init__(self, model_name=EMBEDDING_LOCAL_MODEL, cache_dir=None, threads=None):
+        from fastembed import TextEmbedding
+
+        logger.info(f"load local embedding model {model_name}, threads {threads}")
+        self.model_name = model_name
+        self.model = TextEmbedding(model_name=model_name, cache_dir=cache_dir, threads=threads)
+
+    def embed_documents(self, texts):
+        vectors = self.model.embed(texts, batch_size=EMBEDDING_LOCAL_BATCH_SIZE)
+        return [vector.tolist() for vector in vectors]
+
+    def embed_query(self, text):
+        return next(iter(self.model.query_embed(text))).tolist()
+
+
+def get_local_threads(concurrency):
+    """
+    ONNX threads per session run, the cores are shared by the batches in flight
+    """
+    threads = os.getenv("EMBEDDING_LOCAL_THREADS")
+    if threads:
+        return int(threads)
+    return max(1, (os.cpu_count() or 1) // concurrency)
@@ -60,6 +60,10 @@ def get_file_md5(path):
     return md5
 
 
+def get_text_md5(text):
+    return hashlib.md5(text.encode("utf-8")).hexdigest()
+
+
 def get_front_matter(info_path, info=None):
     """
     Extract raw file information
@@ -1,7 +1,7 @@
 import re
 import json
 from loguru import logger
-from django.http import HttpResponse, FileResponse
+from django.http import HttpResponse, FileResponse, HttpResponseRedirect
 from backend import settings
 
 def do_result(ret, detail):
@@ -10,6 +10,9 @@ def do_result(ret, detail):
         if isinstance(detail, str):
             dic["info"] = detail
         elif isinstance(detail, dict):
+            if "type" in detail and detail["type"] == "file" and "url" in detail:
+                # presigned url of the file store, the client fetches the bytes itself
+                return HttpResponseRedirect(detail["url"])
             if ("type" in detail
                 and detail["type"] in ["file", "audio"]
                 and "path" in detail
@@ -38,6 +41,32 @@ def do_result(ret, detail):
             return HttpResponse(json.dumps({"status": "failed"}))
 
 
+def parse_range(header, size):
+    """
+    Parse a single HTTP Range header, e.g. bytes=0-99, bytes=100-, bytes=-100
+    Return (start, end) with end included, None to send the whole file
+    (no header, or several ranges), raise ValueError if it can't be satisfied
+    """
+    if header is None:
+        return None
+    match = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", header)
+    if match is None:
+        return None
+    start, end = match.groups()
+    if start == "" and end == "":
+        return None
+    if start == "":
+        length = int(end)
+        if length == 0:
+            raise ValueError(f"unsatisfiable range {header}")
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = size - 1 if end == "" else min(int(end), size - 1)
+    if start >= size or start > end:
+        raise ValueError(f"unsatisfiable range {header}")
+    return start, end
+
+
 def is_valid_url(s):
     # Use regular expressions to check if the string is a valid URL
     url_pattern = re.compile(
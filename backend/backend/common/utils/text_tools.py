@@ -1,9 +1,13 @@
 import re
 import json
+import jieba
 import datetime
 from loguru import logger
 from babel import Locale
 
+CJK_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]")
+
+
 def replace_chinese_punctuation_with_english(s):
     punctuation_dict = {
         "，": ",",
@@ -90,4 +94,16 @@ def get_language_name(language_code):
         return locale.get_display_name()
     except Exception as e:
         logger.warning(f"Error: {e}")
-        return None
\ No newline at end of file
+        return None
+
+
+def segment_text(text):
+    """
+    Split CJK text into space separated words (jieba search mode) for full-text search,
+    text without CJK characters is returned as is
+    """
+    if text is None:
+        return ""
+    if not CJK_PATTERN.search(text):
+        return text
+    return " ".join([word for word in jieba.cut_for_search(text) if word.strip()])
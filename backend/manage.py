@@ -11,6 +11,10 @@ def init_django():
         execute_from_command_line([sys.argv[0], "compilemessages"])
         execute_from_command_line([sys.argv[0], "makemigrations"])
         execute_from_command_line([sys.argv[0], "migrate"])
+        # legacy chunk rows must leave store_entry before the entry queries see them
+        execute_from_command_line([sys.argv[0], "split_blocks"])
+        # rows saved before the full-text column are invisible to keyword search, only NULL ones are filled
+        execute_from_command_line([sys.argv[0], "search_vector"])
     except Exception as e:
         logger.warning(f'初始化失败: {e}')
 
@@ -232,6 +232,42 @@ class BMKeeperSearchTestCase(BMKeeperBaseTestCase):
         except Exception as e:
             self.fail(f"Search no results test failed: {e}")
 
+    def test_d_search_cjk(self):
+        """Test search in Chinese title, segmented before indexing"""
+        try:
+            StoreEntry.objects.create(
+                idx=str(uuid.uuid4()),
+                user_id=self.test_user.username,
+                title="北京天气预报",
+                addr="https://weather.example.com",
+                source=SOURCE,
+                is_deleted="f",
+                status="collect",
+                created_time=timezone.now(),
+            )
+            response = self.client.get("/api/keeper/", {
+                "type": "search",
+                "param": "天气"
+            })
+            data = self.parse_return_info(response)
+            self.assertEqual(len(data["data"]), 1)
+            self.assertEqual(data["data"][0]["title"], "北京天气预报")
+        except Exception as e:
+            self.fail(f"Search cjk test failed: {e}")
+
+    def test_e_search_partial(self):
+        """Test part of a word, not found by full-text search, matches as substring"""
+        try:
+            response = self.client.get("/api/keeper/", {
+                "type": "search",
+                "param": "jango"
+            })
+            data = self.parse_return_info(response)
+            self.assertEqual(len(data["data"]), 1)
+            self.assertEqual(data["data"][0]["title"], "Django Web Framework")
+        except Exception as e:
+            self.fail(f"Search partial test failed: {e}")
+
 
 class BMKeeperTreeTestCase(BMKeeperBaseTestCase):
     """Test cases for tree view features"""
@@ -0,0 +1,452 @@
+import io
+import os
+import math
+import datetime
+import json
+import unittest
+from unittest import mock
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Max
+from django.utils import timezone
+from .support import BaseTestCase
+from app_dataforge.models import StoreEntry, StoreBlock, BackfillJob, IngestJob
+from app_dataforge.entry import (
+    get_entry_list,
+    fts_search,
+    save_entry,
+    is_content_unchanged,
+    get_vector_blocks,
+    get_vector_scan_size,
+    update_entry_fields,
+)
+from backend.common.parser.utils_md import get_text_md5
+from app_dataforge import ingest, emb_cache, backfill, vector_index
+from app_bm_keeper.common import get_base_query
+from app_sync.views import get_vault_entries
+
+
+class IndexPlanTestCase(BaseTestCase):
+    """
+    Query plan regression: hot StoreEntry filters must be served by the indexes in models.py
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.user_id = "testuser"
+        for idx in range(20):
+            StoreEntry.objects.create(
+                user_id=self.user_id,
+                title=f"note {idx}",
+                etype="note",
+                addr=f"vault/note_{idx}.md",
+                created_time=timezone.now(),
+            )
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE store_entry")
+            # the test table is tiny, make the planner show which index it would use
+            cursor.execute("SET enable_seqscan = off")
+
+    def tearDown(self):
+        with connection.cursor() as cursor:
+            cursor.execute("RESET enable_seqscan")
+        super().tearDown()
+
+    def assertUseIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan, plan)
+
+    def test_1_list(self):
+        queryset = get_entry_list(None, {"user_id": self.user_id}, 10)
+        self.assertUseIndex(queryset, "store_entry_list")
+
+    def test_2_sync(self):
+        queryset = get_vault_entries(self.user_id, "vault/").values(
+            "idx", "updated_time", "md5", "is_deleted", "addr"
+        )
+        self.assertUseIndex(queryset, "store_entry_sync")
+        queryset = get_vault_entries(self.user_id, "vault/").values("user_id").annotate(
+            Max("updated_time")
+        )
+        self.assertUseIndex(queryset, "store_entry_sync")
+
+    def test_3_bookmark(self):
+        self.assertUseIndex(get_base_query(self.user_id), "store_entry_source")
+        queryset = get_base_query(self.user_id, query_type="readlater").order_by("-created_time")
+        self.assertUseIndex(queryset, "store_entry_status")
+
+    def test_4_addr(self):
+        queryset = StoreEntry.objects.filter(user_id=self.user_id, addr="vault/note_1.md")
+        self.assertUseIndex(queryset, "store_entry_user_addr")
+
+    def test_5_session(self):
+        queryset = StoreEntry.objects.filter(
+            user_id=self.user_id, etype="chat"
+        ).order_by("-updated_time").values("addr", "title", "updated_time")[0:20]
+        self.assertUseIndex(queryset, "store_entry_recent")
+
+
+
+class BlockTestCase(BaseTestCase):
+    def test_save_entry(self):
+        """
+        Chunks are saved to store_block, the entry table only has one row per addr
+        """
+        dic = {"user_id": "testuser", "etype": "record", "addr": "record_block_test"}
+        content = "\n\n".join([f"paragraph {idx} " * 40 for idx in range(10)])
+        ret, ret_emb, detail = save_entry(dic, "abstract", content)
+        self.assertTrue(ret)
+        entries = StoreEntry.objects.filter(user_id="testuser", addr="record_block_test")
+        self.assertEqual(entries.count(), 1)
+        blocks = StoreBlock.objects.filter(entry=entries[0]).order_by("ordinal")
+        self.assertGreater(blocks.count(), 1)
+        self.assertEqual(list(blocks.values_list("ordinal", flat=True)), list(range(1, blocks.count() + 1)))
+        queryset = get_entry_list("paragraph", {"user_id": "testuser"}, 10)
+        self.assertEqual([x["addr"] for x in queryset], ["record_block_test"])
+        for block in blocks:
+            self.assertEqual(block.md5, get_text_md5(block.raw))
+
+    def test_incremental_update(self):
+        """
+        Editing one paragraph keeps the rows of the other chunks
+        """
+        dic = {"user_id": "testuser", "etype": "note", "addr": "vault/edit.md"}
+        paragraphs = [(f"paragraph {idx} " * 40).strip() for idx in range(10)]
+        save_entry(dic.copy(), None, "\n\n".join(paragraphs))
+        entry = StoreEntry.objects.get(user_id="testuser", addr="vault/edit.md")
+        before = dict(StoreBlock.objects.filter(entry=entry).values_list("md5", "pk"))
+
+        paragraphs[5] = ("changed " * 50).strip()
+        paragraphs.insert(0, ("inserted " * 50).strip())
+        save_entry(dic.copy(), None, "\n\n".join(paragraphs))
+        entries = StoreEntry.objects.filter(user_id="testuser", addr="vault/edit.md")
+        self.assertEqual([x.idx for x in entries], [entry.idx])
+        blocks = list(StoreBlock.objects.filter(entry=entry).order_by("ordinal"))
+        self.assertEqual([x.raw for x in blocks], paragraphs)
+        kept = [x for x in blocks if x.md5 in before]
+        self.assertEqual(len(kept), 9)
+        for block in kept:
+            self.assertEqual(block.pk, before[block.md5])
+        self.assertEqual([x.ordinal for x in blocks], list(range(1, 12)))
+
+    def test_unchanged_content(self):
+        dic = {"user_id": "testuser", "etype": "note", "addr": "vault/same.md", "md5": "abc"}
+        self.assertFalse(is_content_unchanged(dic))
+        save_entry(dic.copy(), None, "some content")
+        self.assertTrue(is_content_unchanged(dic))
+        self.assertFalse(is_content_unchanged({**dic, "md5": "abd"}))
+
+        # a metadata-only edit of unchanged content is still written
+        self.assertTrue(update_entry_fields({**dic, "status": "todo", "title": None}))
+        entry = StoreEntry.objects.get(user_id="testuser", addr="vault/same.md")
+        self.assertEqual(entry.status, "todo")
+        self.assertEqual(StoreBlock.objects.filter(entry=entry).count(), 1)
+
+        # the new title is in search_vector, keyword search finds it
+        self.assertTrue(update_entry_fields({**dic, "title": "renamed quokka"}))
+        queryset = get_entry_list("quokka", {"user_id": "testuser"}, 10)
+        self.assertEqual([x["addr"] for x in queryset], ["vault/same.md"])
+
+    def test_trigram_fallback(self):
+        save_entry(
+            {"user_id": "testuser", "etype": "note", "addr": "vault/trgm.md", "title": "trigram fallback"},
+            None,
+            "some content",
+        )
+        queryset = get_entry_list("trigrm fallbak", {"user_id": "testuser"}, 10)
+        self.assertEqual([x["addr"] for x in queryset], ["vault/trgm.md"])
+
+    def test_search_vector_backfill(self):
+        """
+        Rows from before the full-text column are found again after the startup backfill
+        """
+        dic = {"user_id": "testuser", "etype": "note", "addr": "vault/old.md", "title": "legacy wombat"}
+        save_entry(dic, None, None)
+        StoreEntry.objects.filter(addr="vault/old.md").update(search_vector=None)
+        self.assertEqual(fts_search("wombat", {"user_id": "testuser"}, 10), [])
+        call_command("search_vector", stdout=io.StringIO())
+        self.assertEqual(StoreEntry.objects.filter(search_vector__isnull=True).count(), 0)
+        self.assertEqual(len(fts_search("wombat", {"user_id": "testuser"}, 10)), 1)
+
+    def test_failed_embedding(self):
+        """
+        An entry whose chunks got no vector doesn't take the model name, it's not skipped next time
+        """
+        env = {
+            "USE_EMBEDDING": "True",
+            "EMBEDDING_TYPE": "ollama",
+            "EMBEDDING_OLLAMA_URL": "http://127.0.0.1:1",
+            "EMBEDDING_OLLAMA_MODEL": "failed-model",
+            "EMBEDDING_RETRIES": "1",
+            "EMBEDDING_CACHE": "False",
+        }
+        dic = {"user_id": "testuser", "etype": "note", "addr": "vault/failed.md", "md5": "abc"}
+        with mock.patch.dict(os.environ, env):
+            ret, ret_emb, detail = save_entry(dic.copy(), None, "failed content")
+            self.assertTrue(ret)
+            self.assertFalse(ret_emb)
+            self.assertFalse(is_content_unchanged(dic))
+        entry = StoreEntry.objects.get(user_id="testuser", addr="vault/failed.md")
+        self.assertIsNone(entry.emb_model)
+        self.assertFalse(StoreBlock.objects.filter(entry=entry, emb_model__isnull=False).exists())
+
+
+    def test_embedding_cache(self):
+        texts = ["cached text", "other text"]
+        hashes = [emb_cache.get_text_hash(text) for text in texts]
+        # the same key as the chunk md5, a stored chunk doesn't need hashing again
+        self.assertEqual(hashes[0], get_text_md5("cached text"))
+        self.assertEqual(emb_cache.get_cached("test-model", hashes), {})
+        emb_cache.put_cached("test-model", hashes, [[1.0, 0.0, 0.0], None])
+        cached = emb_cache.get_cached("test-model", hashes)
+        self.assertEqual(list(cached.keys()), [hashes[0]])
+        self.assertEqual(list(cached[hashes[0]]), [1.0, 0.0, 0.0])
+        self.assertEqual(emb_cache.get_cached("other-model", hashes), {})
+        stats = [x for x in emb_cache.get_stats() if x["emb_model"] == "test-model"]
+        self.assertEqual(stats[0]["hits"], 1)
+        self.assertEqual(stats[0]["hit_rate"], 0.5)
+
+    def test_vector_search_params(self):
+        with transaction.atomic():
+            vector_index.set_search_params(200)
+            with connection.cursor() as cursor:
+                cursor.execute("SHOW hnsw.ef_search")
+                self.assertEqual(cursor.fetchone()[0], "200")
+                cursor.execute("SHOW ivfflat.probes")
+                self.assertEqual(cursor.fetchone()[0], "10")
+            vector_index.set_search_params(5000)
+            with connection.cursor() as cursor:
+                cursor.execute("SHOW hnsw.ef_search")
+                self.assertEqual(cursor.fetchone()[0], "1000")
+
+    def test_compact_vector_rescore(self):
+        """
+        The halfvec/2-dim index only picks candidates, the order comes from the full vectors
+        """
+        vectors = {"a": [1.0, 0.0, 0.0, 0.0], "b": [1.0, 0.0, 1.0, 0.0], "c": [0.0, 1.0, 0.0, 0.0]}
+        for name, vector in vectors.items():
+            save_entry({"user_id": "testuser", "etype": "note", "addr": f"vault/vec_{name}.md"}, None, name)
+            StoreBlock.objects.filter(entry__addr=f"vault/vec_{name}.md").update(
+                embeddings=vector, emb_model="test-model"
+            )
+        query = [1.0, 0.0, 0.9, 0.0]
+        env = {"VECTOR_INDEX_TYPE": "halfvec", "VECTOR_INDEX_DIMENSIONS": "2"}
+        with mock.patch.dict(os.environ, env):
+            blocks = get_vector_blocks({"user_id": "testuser"}, "test-model", query, 1)
+            addrs = list(blocks.values_list("addr", flat=True))
+        # a and b are the same in the first 2 dimensions, b is nearer by the full vector
+        self.assertEqual(addrs[:2], ["vault/vec_b.md", "vault/vec_a.md"])
+
+    def test_compact_vector_recall(self):
+        """
+        Through a compact hnsw index, the rescored top blocks are the top blocks by the full vectors
+        """
+        count = 120
+        vectors = []
+        for idx in range(count):
+            angle = idx * 2 * math.pi / count
+            # most of the length in the first dimensions, like a model that allows truncation
+            vectors.append(
+                [math.cos(angle), math.sin(angle), 0.3 * math.cos(angle * 7), 0.3 * math.sin(angle * 5)]
+            )
+            entry = StoreEntry.objects.create(
+                user_id="testuser", etype="note", addr=f"vault/recall_{idx}.md", created_time=timezone.now()
+            )
+            StoreBlock.objects.create(
+                entry=entry, ordinal=1, raw=str(idx), embeddings=vectors[-1], emb_model="recall-model"
+            )
+        query = [0.9, 0.2, 0.3, -0.2]
+
+        def cosine_distance(vector):
+            dot = sum(x * y for x, y in zip(vector, query))
+            return 1 - dot / math.sqrt(sum(x * x for x in vector) * sum(x * x for x in query))
+
+        expected = sorted(range(count), key=lambda idx: cosine_distance(vectors[idx]))[:10]
+        expected = [f"vault/recall_{idx}.md" for idx in expected]
+
+        env = {"VECTOR_INDEX_TYPE": "halfvec", "VECTOR_INDEX_DIMENSIONS": "2", "VECTOR_RESCORE_FACTOR": "6"}
+        with mock.patch.dict(os.environ, env), transaction.atomic():
+            expression, opclass = vector_index.get_index_sql(4)
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"CREATE INDEX store_block_recall ON store_block USING hnsw (({expression}) {opclass}) "
+                    "WHERE emb_model = 'recall-model' AND vector_dims(embeddings) = 4"
+                )
+                cursor.execute("ANALYZE store_block")
+                cursor.execute("SET LOCAL enable_seqscan = off")
+            candidates = 10
+            self.assertEqual(get_vector_scan_size(4, candidates), 60)
+            vector_index.set_search_params(get_vector_scan_size(4, candidates))
+            blocks = get_vector_blocks({"user_id": "testuser"}, "recall-model", query, candidates)
+            addrs = list(blocks.values_list("addr", flat=True))
+        # the index scan went past the default ef_search of 40
+        self.assertEqual(len(addrs), 60)
+        self.assertEqual(addrs[:10], expected)
+
+
+class IngestJobTestCase(BaseTestCase):
+    def test_upload_results(self):
+        response = self.client.post(
+            "/api/entry/data/",
+            {
+                "etype": "note",
+                "files": [
+                    SimpleUploadedFile("up1.md", b"upload file 1"),
+                    SimpleUploadedFile("up2.md", b"upload file 2"),
+                ],
+                "filepaths": ["up/up1.md", "/up/up2.md"],
+            },
+            format="multipart",
+        )
+        info = self.parse_return_info(response)
+        self.assertEqual(info["list"], ["up/up1.md", "up/up2.md"])
+        self.assertEqual([x["addr"] for x in info["results"]], ["up/up1.md", "up/up2.md"])
+        self.assertEqual([x["status"] for x in info["results"]], ["done", "done"])
+
+    def test_async_upload(self):
+        response = self.client.post(
+            "/api/entry/data/",
+            {
+                "etype": "note",
+                "async": "true",
+                "files": [
+                    SimpleUploadedFile("job1.md", b"job file 1"),
+                    SimpleUploadedFile("job2.md", b"job file 2"),
+                ],
+                "filepaths": ["job/job1.md", "job/job2.md"],
+            },
+            format="multipart",
+        )
+        info = self.parse_return_info(response)
+        self.assertEqual(info["total"], 2)
+        response = self.client.get(f"/api/entry/job/{info['job']}/")
+        data = json.loads(response.content)
+        self.assertEqual(data["status"], "pending")
+        self.assertEqual(data["progress"], 0)
+
+        ingest.run_worker(once=True)
+        response = self.client.get(f"/api/entry/job/{info['job']}/")
+        data = json.loads(response.content)
+        self.assertEqual(data["status"], "done")
+        self.assertEqual(data["finished"], 2)
+        self.assertNotIn("path", data["items"][0])
+        self.assertTrue(
+            StoreEntry.objects.filter(user_id="testuser", addr="job/job2.md").exists()
+        )
+
+    def test_failed_job(self):
+        """
+        A failed attempt waits for its retry time, a failed job keeps its files and can be retried
+        """
+        dic = {"user_id": "testuser", "etype": "note"}
+        job = ingest.create_job(dic, [(SimpleUploadedFile("retry.md", b"retry file"), "job/retry.md", None)])
+        failure = mock.patch.object(ingest, "add_data", return_value=(False, False, "parse failed"))
+        with mock.patch.dict(os.environ, {"INGEST_MAX_ATTEMPTS": "2"}), failure:
+            ingest.run_worker(once=True)
+            job = IngestJob.objects.get(idx=job.idx)
+            self.assertEqual(job.status, IngestJob.Status.PENDING)
+            self.assertGreater(job.next_run_time, timezone.now())
+            self.assertIsNone(ingest.claim_job("test"))
+
+            IngestJob.objects.filter(idx=job.idx).update(next_run_time=timezone.now())
+            ingest.run_worker(once=True)
+        job = IngestJob.objects.get(idx=job.idx)
+        self.assertEqual(job.status, IngestJob.Status.FAILED)
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(job.error, "parse failed")
+        self.assertTrue(os.path.exists(job.items[0]["path"]))
+
+        response = self.client.post(f"/api/entry/job/{job.idx}/retry/")
+        self.assertEqual(self.parse_return_info(response)["job"], str(job.idx))
+        ingest.run_worker(once=True)
+        job = IngestJob.objects.get(idx=job.idx)
+        self.assertEqual(job.status, IngestJob.Status.DONE)
+        self.assertFalse(os.path.exists(ingest.get_job_dir(job.idx)))
+        self.assertTrue(StoreEntry.objects.filter(user_id="testuser", addr="job/retry.md").exists())
+
+    def test_clear_failed_jobs(self):
+        dic = {"user_id": "testuser", "etype": "note"}
+        job = ingest.create_job(dic, [(SimpleUploadedFile("old.md", b"old file"), "job/old.md", None)])
+        IngestJob.objects.filter(idx=job.idx).update(status=IngestJob.Status.FAILED)
+        ingest.clear_failed_jobs()
+        self.assertTrue(os.path.exists(ingest.get_job_dir(job.idx)))
+        IngestJob.objects.filter(idx=job.idx).update(
+            updated_time=timezone.now() - datetime.timedelta(days=ingest.INGEST_FAILED_KEEP_DAYS + 1)
+        )
+        ingest.clear_failed_jobs()
+        self.assertFalse(os.path.exists(ingest.get_job_dir(job.idx)))
+        self.assertFalse(ingest.retry_job(IngestJob.objects.get(idx=job.idx)))
+
+
+class BackfillTestCase(BaseTestCase):
+    def test_backfill(self):
+        """
+        Chunks saved without embedding are filled in by the worker, vectors come from the cache
+        """
+        for idx in range(3):
+            dic = {"user_id": "testuser", "etype": "note", "addr": f"vault/backfill_{idx}.md"}
+            save_entry(dic, None, f"backfill content {idx}")
+        texts = list(
+            StoreBlock.objects.filter(entry__user_id="testuser", entry__addr__startswith="vault/backfill_")
+            .values_list("raw", flat=True)
+        )
+        hashes = [emb_cache.get_text_hash(text) for text in texts]
+        emb_cache.put_cached("backfill-model", hashes, [[1.0, float(idx), 0.0] for idx in range(len(texts))])
+
+        env = {
+            "USE_EMBEDDING": "True",
+            "EMBEDDING_TYPE": "ollama",
+            "EMBEDDING_OLLAMA_URL": "http://127.0.0.1:1",
+            "EMBEDDING_OLLAMA_MODEL": "backfill-model",
+            "EMBEDDING_BACKFILL_BATCH": "2",
+        }
+        with mock.patch.dict(os.environ, env):
+            self.assertEqual(len(backfill.get_stale_addrs("testuser", "backfill-model")), 3)
+            job = backfill.create_job("testuser", "backfill-model")
+            self.assertEqual(job.total, 3)
+            self.assertEqual(backfill.create_job("testuser", "backfill-model").idx, job.idx)
+            # a concurrent request that missed the queued job hits backfill_job_active
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                BackfillJob.objects.create(user_id="testuser", emb_model="backfill-model")
+            backfill.run_worker(once=True)
+        job = BackfillJob.objects.get(idx=job.idx)
+        self.assertEqual(job.status, BackfillJob.Status.DONE)
+        self.assertEqual(job.finished, 3)
+        self.assertEqual(
+            job.cursor, StoreEntry.objects.filter(user_id="testuser").order_by("-idx")[0].idx
+        )
+        self.assertEqual(backfill.get_stale_addrs("testuser", "backfill-model"), [])
+        self.assertEqual(
+            StoreEntry.objects.filter(addr__startswith="vault/backfill_", emb_model="backfill-model").count(), 3
+        )
+
+    def test_backfill_retry(self):
+        """
+        A pass with failed chunks waits for its retry time instead of being claimed again at once
+        """
+        save_entry({"user_id": "testuser", "etype": "note", "addr": None}, None, "backfill no addr")
+        env = {
+            "USE_EMBEDDING": "True",
+            "EMBEDDING_TYPE": "ollama",
+            "EMBEDDING_OLLAMA_URL": "http://127.0.0.1:1",
+            "EMBEDDING_OLLAMA_MODEL": "backfill-model",
+            "EMBEDDING_RETRIES": "1",
+        }
+        with mock.patch.dict(os.environ, env):
+            job = backfill.create_job("testuser", "backfill-model")
+            self.assertEqual(job.total, 1)
+            backfill.run_worker(once=True)
+            job = BackfillJob.objects.get(idx=job.idx)
+            self.assertEqual(job.status, BackfillJob.Status.PENDING)
+            self.assertEqual(job.attempts, 1)
+            self.assertIsNone(job.cursor)
+            self.assertGreater(job.next_run_time, timezone.now())
+            self.assertIsNone(backfill.claim_job("test"))
+
+            BackfillJob.objects.filter(idx=job.idx).update(next_run_time=timezone.now())
+            self.assertEqual(backfill.claim_job("test").idx, job.idx)
+
+
+if __name__ == "__main__":
+    unittest.main()
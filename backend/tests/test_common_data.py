@@ -1,9 +1,12 @@
 import os
 import json
 import unittest
+from unittest import mock
 from loguru import logger
 from django.core.files.uploadedfile import SimpleUploadedFile
 from .support import BaseTestCase
+from app_dataforge.models import StoreBlock
+from app_dataforge.entry import save_entry, hybrid_search
 
 
 class DataFileTestCase(BaseTestCase):
@@ -179,6 +182,58 @@ class EmbeddingTestCase(BaseTestCase):
         addrlist = self.inner_check_embedding()
         self.inner_regen_embedding(addrlist)
 
+    def test_vector_search(self):
+        """
+        Semantic search, falls back to keyword search without embedding
+        """
+        self.inner_add_data()
+        response = self.client.get(
+            "/api/entry/data/", {"keyword": "天气", "search_mode": "vector"}
+        )
+        self.assertEqual(response.status_code, 200)
+        print(f"vector search has {response.data['count']} items")
+        addrs = [x["addr"] for x in response.data["results"]]
+        self.assertEqual(len(addrs), len(set(addrs)))
+
+    def test_hybrid_search(self):
+        """
+        Full-text and vector search fused by reciprocal rank
+        """
+        self.inner_add_data()
+        response = self.client.get(
+            "/api/entry/data/", {"keyword": "天气", "search_mode": "hybrid"}
+        )
+        self.assertEqual(response.status_code, 200)
+        scores = [x["score"] for x in response.data["results"] if "score" in x]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+
+    def test_hybrid_search_fusion(self):
+        """
+        Keyword-only and vector-only hits are both returned, a hit in both lists ranks first
+        """
+        entries = {
+            "vault/hybrid_both.md": ("quokka on rottnest island", [1.0, 0.0, 0.0]),
+            "vault/hybrid_keyword.md": ("quokka photos from the trip", None),
+            "vault/hybrid_vector.md": ("small marsupial of the island", [0.9, 0.1, 0.0]),
+        }
+        for addr, (raw, vector) in entries.items():
+            save_entry({"user_id": "testuser", "etype": "note", "addr": addr}, None, raw)
+            if vector is not None:
+                StoreBlock.objects.filter(entry__addr=addr).update(
+                    embeddings=vector, emb_model="test-model"
+                )
+        with mock.patch(
+            "app_dataforge.entry.get_query_embedding", return_value=("test-model", [1.0, 0.0, 0.0])
+        ):
+            hits = hybrid_search("quokka", {"user_id": "testuser", "is_deleted": False}, 10)
+        hits = {hit["addr"]: hit for hit in hits if hit["addr"] in entries}
+        self.assertEqual(set(hits), set(entries))
+        self.assertIsNone(hits["vault/hybrid_keyword.md"]["vec_rank"])
+        self.assertIsNone(hits["vault/hybrid_vector.md"]["fts_rank"])
+        best = max(hits.values(), key=lambda hit: hit["score"])
+        self.assertEqual(best["addr"], "vault/hybrid_both.md")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,6 +1,12 @@
 import os
+import fcntl
+import shutil
+import tempfile
 import unittest
+from unittest import mock
 from django.core.files.uploadedfile import SimpleUploadedFile
+from backend.common.files import filecache, utils_filemanager
+from app_dataforge.models import StoreEntry
 from .support import BaseTestCase
 
 
@@ -22,16 +28,189 @@ class FileManagerTestCase(BaseTestCase):
             return data["list"]
         AssertionError(False)
 
+    @mock.patch.dict(os.environ, {"FILE_STORE": "local"})
     def test_1_local_file(self):
-        os.environ["FILE_STORE"] = "local"
         ret = self.inner_upload_file()
         AssertionError(len(ret) > 0)
 
+    @mock.patch.dict(os.environ, {"FILE_STORE": "minio"})
     def test_2_minio_file(self):
-        os.environ["FILE_STORE"] = "minio"
         ret = self.inner_upload_file()
         AssertionError(len(ret) > 0)
 
 
+    @mock.patch.dict(os.environ, {"FILE_STORE": "local"})
+    def test_3_download_range(self):
+        file_data = b"0123456789" * 10000
+        response = self.client.post(
+            "/api/entry/data/",
+            {"etype": "file", "files": SimpleUploadedFile("range.bin", file_data), "filepaths": "range.bin"},
+            format="multipart",
+        )
+        self.parse_return_info(response)
+        idx = StoreEntry.objects.get(user_id="testuser", addr="range.bin").idx
+        response = self.client.get(f"/api/entry/data/{idx}/download/")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(b"".join(response.streaming_content), file_data)
+        response = self.client.get(f"/api/entry/data/{idx}/download/", HTTP_RANGE="bytes=10-19")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], f"bytes 10-19/{len(file_data)}")
+        self.assertEqual(b"".join(response.streaming_content), file_data[10:20])
+        response = self.client.get(f"/api/entry/data/{idx}/download/", HTTP_RANGE="bytes=-5")
+        self.assertEqual(b"".join(response.streaming_content), file_data[-5:])
+        response = self.client.get(f"/api/entry/data/{idx}/download/", HTTP_RANGE=f"bytes={len(file_data)}-")
+        self.assertEqual(response.status_code, 416)
+
+        with mock.patch.dict(os.environ, {"FILE_DELIVERY": "redirect"}):
+            response = self.client.get(f"/api/entry/data/{idx}/download/")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["X-Sendfile"].endswith("/testuser/files/range.bin"))
+        self.assertEqual(response.content, b"")
+
+
+class TmpFileTestCase(unittest.TestCase):
+    def test_unique_tmpfile(self):
+        paths = set([filecache.get_tmpfile(".md") for i in range(1000)])
+        self.assertEqual(len(paths), 1000)
+
+    def test_upload_tmpfile(self):
+        data = b"0123456789" * 300000
+        file = SimpleUploadedFile("big.bin", data)
+        with filecache.upload_tmpfile(file, ".bin") as path:
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), data)
+        self.assertFalse(os.path.exists(path))
+
+    def test_file_info(self):
+        manager = filecache.TmpFileManager.get_instance()
+        path = filecache.get_tmpfile(".html")
+        with open(path, "w") as f:
+            f.write("<html></html>")
+        manager.add_file(path, {"url": f"http://test/{os.path.basename(path)}"})
+        self.assertEqual(manager.get_file_by_key("url", f"http://test/{os.path.basename(path)}"), path)
+        manager.set_file_info(path, "abstract", "abstract")
+        self.assertEqual(manager.get_file_info(path)["abstract"], "abstract")
+        os.remove(path)
+        self.assertIsNone(manager.get_file_by_key("url", f"http://test/{os.path.basename(path)}"))
+
+    def test_lru_evict(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            # a manager of its own, the shared cache db and tmp dir are left alone
+            with mock.patch.object(filecache, "TMPFILE_DIR", os.path.join(tmp_dir, "files")):
+                manager = filecache.TmpFileManager(data_dir=tmp_dir)
+                paths = []
+                for i in range(3):
+                    path = filecache.get_tmpfile(".html")
+                    with open(path, "w") as f:
+                        f.write("x" * 1000)
+                    manager.add_file(path, {"url": f"http://lru/{os.path.basename(path)}"})
+                    paths.append(path)
+                manager.get_file_by_key("url", f"http://lru/{os.path.basename(paths[0])}")
+                # room for the two most recently used files only
+                with mock.patch.dict(os.environ, {"TMPFILE_CACHE_SIZE": str(2000.5 / 1024 / 1024)}):
+                    evicted = manager.evict()
+                self.assertEqual(evicted, [paths[1]])
+                self.assertFalse(os.path.exists(paths[1]))
+                self.assertTrue(os.path.exists(paths[0]))
+                self.assertEqual(manager.get_stats()["evictions"], 1)
+                manager.get_conn().close()
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class LocalDedupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp()
+        self.manager = utils_filemanager.LocalFileManager(self.base_path, dedup=True)
+        self.src = os.path.join(self.base_path, "src.bin")
+        with open(self.src, "wb") as f:
+            f.write(b"same attachment" * 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path, ignore_errors=True)
+
+    def test_dedup(self):
+        manager = self.manager
+        self.assertTrue(manager.save_file("user1", "files/a.bin", self.src))
+        self.assertTrue(manager.save_file("user2", "files/b.bin", self.src))
+        path_a = manager.get_local_path("user1", "files/a.bin")
+        path_b = manager.get_local_path("user2", "files/b.bin")
+        blob_path = manager.find_blob(path_a)
+        self.assertIsNotNone(blob_path)
+        self.assertTrue(os.path.samefile(path_a, path_b))
+        self.assertEqual(os.stat(blob_path).st_nlink, 3)
+
+        self.assertTrue(manager.rename_file("user1", "files/a.bin", "files/c.bin"))
+        self.assertEqual(os.stat(blob_path).st_nlink, 3)
+        self.assertTrue(manager.delete_file("user1", "files/c.bin"))
+        self.assertTrue(os.path.exists(blob_path))
+        self.assertTrue(manager.delete_file("user2", "files/b.bin"))
+        self.assertFalse(os.path.exists(blob_path))
+
+    def test_overwrite(self):
+        manager = self.manager
+        manager.save_file("user1", "files/a.bin", self.src)
+        old_blob = manager.find_blob(manager.get_local_path("user1", "files/a.bin"))
+        with open(self.src, "wb") as f:
+            f.write(b"new content")
+        manager.save_file("user1", "files/a.bin", self.src)
+        self.assertFalse(os.path.exists(old_blob))
+        with open(manager.get_local_path("user1", "files/a.bin"), "rb") as f:
+            self.assertEqual(f.read(), b"new content")
+
+    def test_lock_blobs(self):
+        """
+        The blob lock is a file lock, other processes (a second open file) wait for it
+        """
+        lock_path = os.path.join(self.base_path, ".blobs", ".lock")
+        with self.manager.lock_blobs():
+            with open(lock_path, "a") as f:
+                with self.assertRaises(BlockingIOError):
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        with open(lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+class MinioUploadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.manager = utils_filemanager.MinioFileManager.__new__(utils_filemanager.MinioFileManager)
+        self.manager.client = mock.Mock()
+        self.manager.bucket_ready = True
+        fd, self.src = tempfile.mkstemp()
+        with os.fdopen(fd, "wb") as f:
+            f.write(b"minio upload")
+        self.md5 = utils_filemanager.get_md5(self.src)
+
+    def tearDown(self):
+        os.remove(self.src)
+
+    def test_upload(self):
+        """
+        A first upload doesn't stat the object, the md5 of the caller is kept as metadata
+        """
+        self.assertTrue(self.manager.save_file("user1", "files/a.bin", self.src, md5=self.md5))
+        self.manager.client.stat_object.assert_not_called()
+        self.assertEqual(self.manager.client.fput_object.call_args.kwargs["metadata"], {"md5": self.md5})
+
+    def test_resume(self):
+        stat = mock.Mock(size=os.path.getsize(self.src), metadata={"x-amz-meta-md5": self.md5})
+        self.manager.client.stat_object.return_value = stat
+        self.assertTrue(self.manager.save_file("user1", "files/a.bin", self.src, resume=True))
+        self.manager.client.fput_object.assert_not_called()
+
+    def test_open_stream(self):
+        """
+        With the size from get_size a ranged download is one GET, without a second HEAD
+        """
+        stream = self.manager.open_stream("user1", "files/a.bin", 2, 4, size=12)
+        self.manager.client.stat_object.assert_not_called()
+        self.manager.client.get_object.assert_called_once_with(
+            utils_filemanager.MinioFileManager.BUCKET_NAME, "user1/files/a.bin", offset=2, length=4
+        )
+        self.assertEqual(stream.size, 12)
+
+
 if __name__ == "__main__":
     unittest.main()
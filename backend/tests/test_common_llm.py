@@ -1,8 +1,13 @@
+import os
+import importlib.util
+import threading
 import unittest
+from unittest import mock
 from .support import BaseTestCase
 from django.test import TestCase
 from backend.common.llm import llm_hub
 from backend.common.llm import llm_tools
+from backend.common.llm.local_embedding import LocalEmbeddings
 from loguru import logger
 
 
@@ -141,5 +146,82 @@ class AllLLMTestCase(TestCase):
         # self.assertIsInstance(result[1], str)
 
 
+class FakeEmbeddings:
+    """
+    Embeds "n" as [n], a batch starting with a text in fail raises count times, -1 for always
+    """
+
+    def __init__(self, fail=None):
+        self.fail = dict(fail or {})
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        with self.lock:
+            self.calls.append(list(texts))
+            count = self.fail.get(texts[0], 0)
+            if count != 0:
+                self.fail[texts[0]] = count - 1
+                raise ConnectionError("embedding service unavailable")
+        return [[float(text)] for text in texts]
+
+
+class EmbeddingBatchTestCase(unittest.TestCase):
+    env = {
+        "EMBEDDING_TYPE": "ollama",
+        "EMBEDDING_BATCH_SIZE": "2",
+        "EMBEDDING_CONCURRENCY": "2",
+        "EMBEDDING_RETRIES": "2",
+    }
+    texts = [str(x) for x in range(7)]
+
+    def embed(self, model):
+        instance = mock.Mock()
+        instance.get_model.return_value = model
+        with mock.patch.dict(os.environ, self.env), mock.patch.object(
+            llm_hub.EmbeddingTools, "get_instance", return_value=instance
+        ), mock.patch.object(llm_hub.time, "sleep") as sleep:
+            ret, embeddings = llm_hub.EmbeddingTools.do_embedding(self.texts, True)
+        return ret, embeddings, sleep
+
+    def test_batches_in_order(self):
+        model = FakeEmbeddings()
+        ret, embeddings, sleep = self.embed(model)
+        self.assertTrue(ret)
+        self.assertEqual(embeddings, [[float(x)] for x in range(7)])
+        self.assertEqual(
+            sorted(model.calls), [["0", "1"], ["2", "3"], ["4", "5"], ["6"]]
+        )
+        sleep.assert_not_called()
+
+    def test_transient_failure(self):
+        model = FakeEmbeddings(fail={"2": 1})
+        ret, embeddings, sleep = self.embed(model)
+        self.assertTrue(ret)
+        self.assertEqual(embeddings, [[float(x)] for x in range(7)])
+        self.assertEqual(model.calls.count(["2", "3"]), 2)
+        self.assertEqual(sleep.call_count, 1)
+
+    def test_permanent_failure(self):
+        model = FakeEmbeddings(fail={"2": -1})
+        ret, embeddings, sleep = self.embed(model)
+        self.assertFalse(ret)
+        self.assertEqual(embeddings[2:4], [None, None])
+        self.assertEqual(embeddings[:2] + embeddings[4:], [[0.0], [1.0], [4.0], [5.0], [6.0]])
+        # the first try and EMBEDDING_RETRIES retries, no more
+        self.assertEqual(model.calls.count(["2", "3"]), 3)
+        self.assertEqual(sleep.call_count, 2)
+
+
+@unittest.skipUnless(importlib.util.find_spec("fastembed"), "fastembed not installed")
+class LocalEmbeddingTestCase(unittest.TestCase):
+    def test_embed(self):
+        model = LocalEmbeddings()
+        embeddings = model.embed_documents(["hello world", "你好世界", "hello world"])
+        self.assertEqual(len(embeddings), 3)
+        self.assertEqual(embeddings[0], embeddings[2])
+        self.assertEqual(len(model.embed_query("hello")), len(embeddings[0]))
+
+
 if __name__ == "__main__":
     unittest.main()